@@ -1,35 +1,566 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
-import base64
+import logging
+import orjson
+import binascii
+import bisect
 import os
 import re
+import string
 import time
 import sys
+import threading
 import argparse
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import fitz  # PyMuPDF
 from PIL import Image
 import io
-from dotenv import load_dotenv
+from dotenv import dotenv_values
 import datetime
+import functools
+from operator import itemgetter
+import hashlib
 import pytz
 
-# Load environment variables from .env file
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Mathpix rejects PDF uploads larger than 1 GB
+MAX_PDF_BYTES = 1024 ** 3
+
+# How often to poll a /v3/pdf job, and by default how long to wait before giving up (seconds)
+PDF_POLL_INTERVAL = 2
+PDF_JOB_TIMEOUT = 600
+
+# Where Mathpix results are cached, keyed by the SHA-256 of the page image
+# (/v3/text) or of the whole PDF file (/v3/pdf)
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "epigram" / "mathpix"
+
+# Page rendering for OCR: default resolution, a cap on the long side in pixels,
+# and the text-layer length above which a page is rendered smaller as JPEG
+DEFAULT_RENDER_DPI = 144
+MAX_RENDER_LONG_SIDE = 2400
+TEXT_DENSE_PAGE_CHARS = 500
+
+# Extracted color figures are saved as lossy WebP at this quality; grayscale figures
+# and images smaller than WEBP_MIN_PIXELS stay PNG, where PNG is as small and as fast
+WEBP_QUALITY = 90
+WEBP_MIN_PIXELS = 64 * 64
+
+# Base64 image data is decoded this many characters at a time (a multiple of 4,
+# so every chunk holds whole base64 quanta)
+BASE64_CHUNK_CHARS = 64 * 1024
+
+# Pages whose embedded text layer is shorter than this are treated as scans
+MIN_TEXT_LAYER_CHARS = 50
+
+# A PDF whose text layer averages at least this many characters per page is parsed
+# straight from that layer; only pages with an empty or garbled layer go to Mathpix
+TEXT_LAYER_FAST_PATH_CHARS = 500
+
+# Text layers with a larger share of non-ASCII characters than this are treated as garbled
+MAX_TEXT_LAYER_NON_ASCII = 0.3
+
+# Header/footer text and exam metadata stripped from each page before parsing.
+# Joined into one alternation so a page is swept once instead of once per pattern.
+_PAGE_FILTER_RE = re.compile('|'.join(f'(?:{p})' for p in [
+    r'Gstudocu.*?Studocu.*?university',
+    r'Downloaded by.*?@.*?\.com',
+    r'Scan to open on Studocu',
+    r'Studocu is not sponsored.*?university',
+    r'Introduction to Calculus.*?University of Pennsylvania',
+    r'103finalfall 2014 withans',
+    r'Page \d+ of \d+',
+    r'©.*?All rights reserved',
+    r'Confidential',
+    r'Draft',
+    r'Final Exam',
+    r'Name:.*?',
+    r'Student ID:.*?',
+    r'Date:.*?',
+    r'Time:.*?',
+    r'Instructions:.*?',
+    r'Total Points:.*?',
+    r'Show all work',
+    r'No calculators allowed',
+    r'Good luck',
+    # McGill header patterns
+    r'\)\s*Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
+    r'Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
+    # McGill exam instructions and metadata
+    r'Course:\s*MATH\s*\d+.*?Page number:\s*\d+\s*of\s*\d+',
+    r'INSTRUCTIONS\s*-\s*You have until.*?enjoy the summer!',
+    r'You have until.*?submit it on myCourses.*?No late submissions will be accepted',
+    r'All solutions should be your own.*?solve the problems',
+    r'Show and justify each step.*?simplify the answers',
+    r'You may answer the questions directly.*?single PDF file',
+    r'Stay safe and enjoy the summer!',
+    # Exam instructions and metadata
+    r'University of Pennsylvania.*?Math 103.*?Fall 2014',
+    r'Name.*?PRINT.*?Professor.*?Rimmer.*?Wong.*?Towsner',
+    r'Penn ID.*?Recitation Number.*?Rec\. Day.*?Rec\. Time',
+    r'This exam has.*?multiple choice questions.*?open-ended questions',
+    r'Each question is worth.*?points',
+    r'Partial credit will be given.*?supporting work',
+    r'correct answer with little or no supporting work.*?little or no credit',
+    r'Use the space provided.*?scrap paper is provided',
+    r'If you write on the back.*?indicate this in some way',
+    r'You have 120 minutes.*?complete the exam',
+    r'You are not allowed.*?calculator.*?electronic device',
+    r'You are allowed to use.*?handwritten notes',
+    r'Please silence.*?electronic devices',
+    r'When you finish.*?120 minutes has elapsed',
+    r'When time is up.*?collect your exam',
+    r'Once you have completed.*?academic integrity statement',
+    r'Do NOT write in the grid.*?grading purposes only',
+    r'\\begin\{tabular\}.*?\\end\{tabular\}',
+    r'My signature below.*?Academic Integrity.*?examination paper',
+    r'Name \(printed\).*?Score.*?Signature.*?Date',
+    r'Problem.*?Points.*?Problem.*?Points',
+    r'\\hline.*?\\hline',
+    r'\\\\.*?\\\\',
+]), re.IGNORECASE | re.DOTALL)
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Characters a2b_base64 skips (line breaks and the like); they are dropped before
+# the data is chunked so that chunk boundaries fall on whole base64 quanta
+_NON_BASE64_RE = re.compile(r'[^A-Za-z0-9+/=]')
+
+# Problem number markers used to locate problem boundaries on a page: "1." and
+# "Problem 1". Both are found in a single scan, each in its own optional lookahead
+# (groups m0 / m1), so "Problem 3." still yields a boundary for each marker
+_BOUNDARY_RE = re.compile(
+    r'(?=\d|Problem)'
+    r'(?=(?P<m0>(?P<num>\d+)\.))?'
+    r'(?=(?P<m1>Problem\s+(?P<problem_num>\d+)))?'
+)
+
+# The same markers at the start of a PDF text block, used to place problems on the page
+_BLOCK_PROBLEM_RE = re.compile(r'\s*(?:(?P<num>\d+)\.|Problem\s+(?P<problem_num>\d+))')
+
+# Candidate problem layouts, tried in order of specificity by _parse_page_content
+_PROBLEM_PATTERNS = [re.compile(p, re.DOTALL | re.IGNORECASE | re.MULTILINE) for p in [
+    r'(?:^|\n)\s*(\d+)\.\s*(.+?)(?=(?:^|\n)\s*\d+\.\s|\Z)',  # "1. problem text" - more strict about line boundaries
+    r'(?:^|\n)\s*Problem\s+(\d+)[:\.]?\s*(.+?)(?=(?:^|\n)\s*Problem\s+\d+|\Z)',  # "Problem 1: text"
+    r'(?:^\d+\s+)?(\d+)\s+([A-Z][a-z]*(?:\s+[a-z]+)*?)\s+([a-z]\.\s+.*|Let\s+.*)',  # MIT format: "1 Title" + content, handles page numbers
+    r'(\d+)\.\s*(.+?)(?=\d+\.\s|\Z)',  # Simple: "1. text" without strict line boundaries
+    r'(\d+)\)\s*(.+?)(?=\d+\)\s|\Z)',  # "1) problem text"
+    r'(\d+)\s*[-–—]\s*(.+?)(?=\d+\s*[-–—]|\Z)',  # "1 - problem text" or "1 – problem text"
+]]
+
+# Detection patterns below are matched case-sensitively against text lowercased with
+# _ASCII_LOWERCASE, which keeps the regex engine's literal fast paths that IGNORECASE
+# turns off. (str.lower() would not do: it turns İ into two characters, moving \b)
+
+# Math-related content; joined into one alternation so a single scan finds any indicator
+_MATH_INDICATOR_RE = re.compile('|'.join([
+    r'\b(derivative|integral|limit|function|equation|solve|find|calculate|compute)\b',
+    r'[a-zA-Z]\([a-zA-Z]\)',  # f(x), g(y), etc.
+    r'[0-9]+\s*[+\-*/]\s*[0-9]+',  # Basic arithmetic
+    r'[a-zA-Z]\s*=\s*[a-zA-Z0-9+\-*/()]+',  # Variable assignments
+    r'[a-zA-Z]\^[0-9]+',  # x^2, y^3, etc.
+    r'\\frac\{.*?\}\{.*?\}',  # LaTeX fractions
+    r'\\sqrt\{.*?\}',  # LaTeX square roots
+    r'\\int',  # LaTeX integrals
+    r'\\lim',  # LaTeX limits
+]))
+
+# Literal tokens that _MATH_INDICATOR_RE would accept anyway, so a substring check
+# can accept them without running it
+_FAST_MATH_TOKENS = ('\\int', '\\lim')
+
+# Word problem indicators (real-world applications), one named group per
+# category so a single scan both finds a match and reports which kind it was
+_WORD_PROBLEM_RE = re.compile('|'.join(f'(?P<{name}>{p})' for name, p in [
+    ('action', r'\b(?:wishes|wants|needs|must|should|can|will)\b'),
+    ('measurement', r'\b(?:area|perimeter|volume|surface|length|width|height|distance)\b'),
+    ('cost', r'\b(?:cost|price|money|dollars?|cents?)\b'),
+    ('rate', r'\b(?:rate|speed|time|hour|minute|second)\b'),
+    ('ratio', r'\b(?:percent|percentage|ratio|proportion)\b'),
+    ('shape', r'\b(?:rectangle|square|circle|triangle|shape)\b'),
+    ('construction', r'\b(?:fence|build|construct|create|make)\b'),
+    ('optimization', r'\b(?:optimize|minimize|maximize|least|most)\b'),
+]))
+
+# Mathematical expressions in LaTeX
+_LATEX_MATH_PATTERNS = [re.compile(p) for p in [
+    r'\\mathrm\{.*?\}',  # \mathrm{text}
+    r'\\text\{.*?\}',    # \text{text}
+    r'[0-9]+\s*\\mathrm\{.*?\}',  # Numbers with units
+    r'\\[a-zA-Z]+\{.*?\}',  # Any LaTeX command
+]]
+
+# Problem-solving verbs that mark content as a problem statement
+_PROBLEM_KEYWORDS = (
+    'find', 'solve', 'calculate', 'compute', 'determine', 'evaluate',
+    'prove', 'show', 'derive', 'integrate', 'differentiate'
+)
+_PROBLEM_KEYWORD_RE = re.compile('|'.join(_PROBLEM_KEYWORDS))
+
+# Words suggesting a subproblem or solution refers to a figure (all lowercase, matched
+# against lowercased text)
+_SUBPROBLEM_IMAGE_KEYWORDS = (
+    'shaded region', 'graph', 'figure', 'diagram', 'chart', 'below', 'above',
+    'shown', 'illustrated', 'picture', 'image', 'plot', 'curve', 'line'
+)
+_SOLUTION_IMAGE_KEYWORDS = (
+    'graph', 'figure', 'diagram', 'chart', 'below', 'above',
+    'shown', 'illustrated', 'picture', 'image', 'plot', 'curve', 'line',
+    'shaded region', 'shaded area'
+)
+
+# Math indicators for subproblem content (more lenient than _MATH_INDICATOR_RE)
+_SUBPROBLEM_MATH_PATTERNS = [re.compile(p) for p in [
+    r'\b(derivative|integral|limit|function|equation|solve|find|calculate|compute|evaluate)\b',
+    r'[a-zA-Z]\([a-zA-Z]\)',  # f(x), g(y), etc.
+    r'[0-9]+\s*[+\-*/]\s*[0-9]+',  # Basic arithmetic
+    r'[a-zA-Z]\s*=\s*[a-zA-Z0-9+\-*/()]+',  # Variable assignments
+    r'[a-zA-Z]\^[0-9]+',  # x^2, y^3, etc.
+    r'\\frac\{.*?\}\{.*?\}',  # LaTeX fractions
+    r'\\sqrt\{.*?\}',  # LaTeX square roots
+    r'\\int',  # LaTeX integrals
+    r'\\lim',  # LaTeX limits
+    r'\\arcsin|\\arccos|\\arctan',  # LaTeX inverse trig functions
+    r'\\cosh|\\sinh|\\tanh',  # LaTeX hyperbolic functions
+    r'\\cos|\\sin|\\tan',  # LaTeX trig functions
+    r'\\log|\\ln|\\exp',  # LaTeX logarithmic functions
+    r'\\[a-zA-Z]+\s*\([^)]*\)',  # LaTeX functions with arguments
+]]
+
+_LETTER_RE = re.compile(r'[a-zA-Z]')
+
+# McGill header patterns stripped from subproblem content
+_SUBPROBLEM_HEADER_PATTERNS = [re.compile(p, re.IGNORECASE) for p in [
+    r'\)\s*Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
+    r'Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
+]]
+
+# Phrases announcing that subproblems follow
+_SUBPROBLEMS_EXPECTED_PATTERNS = [re.compile(p) for p in [
+    r'find the following',
+    r'determine the following',
+    r'calculate the following',
+    r'evaluate the following',
+    r'compute the following',
+    r'solve the following',
+    r'show the following',
+    r'prove the following',
+]]
+
+# Math operators, counted by _has_math_content with str.translate instead of a regex
+_STRIP_MATH_OPERATORS = str.maketrans('', '', '+-*/=<>≤≥≠≈')
+
+# The remaining math expressions counted by _has_math_content. Each category sits
+# in a zero-width lookahead so one scan tests every position without consuming
+# text another category needs; no two categories can start at the same character,
+# so lastgroup reports every category present
+_MATH_EXPRESSION_RE = re.compile('|'.join(f'(?=(?P<{name}>{p}))' for name, p in [
+    ('variable_op', r'[a-zA-Z]\s*[+\-*/]\s*[a-zA-Z]'),  # Variable operations
+    ('number_op', r'[0-9]+\s*[+\-*/]\s*[0-9]+'),  # Numbers with operators
+    ('function', r'[a-zA-Z]\([a-zA-Z]\)'),  # Function notation
+    ('exponent', r'[a-zA-Z]\^[0-9]+'),  # Exponents
+    ('latex', r'\\[a-zA-Z]+\{.*?\}'),  # LaTeX commands
+]))
+
+# Subproblem marker formats, as (name, pattern) pairs in order of precedence
+_SUBPROBLEM_MARKER_FORMATS = [
+    ('a)', r'(?P<key>[a-zA-Z])\)'),  # a) format - letter followed by closing parenthesis
+    ('a.', r'(?P<key>[a-zA-Z])\.'),  # a. format - letter followed by period
+    ('(a)', r'\((?P<key>[a-zA-Z])\)'),  # (a) format - letter inside parentheses
+    ('i)', r'(?P<key>[iv]+)\)'),  # i) format - roman numerals
+    ('1)', r'(?P<key>\d+)\)'),  # 1) format - numbers followed by parenthesis
+]
+
+# All marker formats in one scan: the leading lookahead stops only where some format
+# matches, and each format's optional lookahead then records its own match there
+# (groups m<i> for the marker and k<i> for its key)
+_SUBPROBLEM_MARKER_RE = re.compile(
+    '(?=' + '|'.join(p.replace('(?P<key>', '(?:') for _, p in _SUBPROBLEM_MARKER_FORMATS) + ')'
+    + ''.join(f"(?=(?P<m{i}>{p.replace('(?P<key>', f'(?P<k{i}>')}))?"
+              for i, (_, p) in enumerate(_SUBPROBLEM_MARKER_FORMATS))
+)
+
+# LaTeX delimiters tracked by _latex_context_mask: \( \) \[ \] and $
+_LATEX_DELIMITER_RE = re.compile(r'\\[()\[\]]|\$')
+
+_TRAILING_NEWLINES_RE = re.compile(r'\n\s*$')
+
+# Page markers, leading problem numbers and metadata stripped by _clean_text
+_PAGE_MARKER_RE = re.compile(r'--- PAGE \d+ ---')
+_LEADING_NUMBER_RE = re.compile(r'^\s*\d+\.\s*')
+
+# Joined into one alternation so the text is swept once instead of once per pattern
+_METADATA_RE = re.compile('|'.join(f'(?:{p})' for p in [
+    r'Gstudocu.*?Studocu.*?university',
+    r'Downloaded by.*?@.*?\.com',
+    r'Scan to open on Studocu',
+    r'Studocu is not sponsored.*?university',
+    r'Introduction to Calculus.*?University of Pennsylvania',
+    r'103finalfall 2014 withans',
+    r'Page \d+ of \d+',
+    r'©.*?All rights reserved',
+    r'Confidential',
+    r'Draft',
+    r'Final Exam',
+    r'Name:.*?',
+    r'Student ID:.*?',
+    r'Date:.*?',
+    r'Time:.*?',
+    r'Instructions:.*?',
+    r'Total Points:.*?',
+    r'Show all work',
+    r'No calculators allowed',
+    r'Good luck',
+    r'jeremywu12345@gmail\.com',
+    r'jeremywu12345',
+    # McGill header patterns
+    r'\)\s*Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
+    r'Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
+    # McGill exam instructions and metadata
+    r'Course:\s*MATH\s*\d+.*?Page number:\s*\d+\s*of\s*\d+',
+    r'INSTRUCTIONS\s*-\s*You have until.*?enjoy the summer!',
+    r'You have until.*?submit it on myCourses.*?No late submissions will be accepted',
+    r'All solutions should be your own.*?solve the problems',
+    r'Show and justify each step.*?simplify the answers',
+    r'You may answer the questions directly.*?single PDF file',
+    r'Stay safe and enjoy the summer!',
+    # Exam instructions and metadata
+    r'University of Pennsylvania.*?Math 103.*?Fall 2014',
+    r'Name.*?PRINT.*?Professor.*?Rimmer.*?Wong.*?Towsner',
+    r'Penn ID.*?Recitation Number.*?Rec\. Day.*?Rec\. Time',
+    r'This exam has.*?multiple choice questions.*?open-ended questions',
+    r'Each question is worth.*?points',
+    r'Partial credit will be given.*?supporting work',
+    r'correct answer with little or no supporting work.*?little or no credit',
+    r'Use the space provided.*?scrap paper is provided',
+    r'If you write on the back.*?indicate this in some way',
+    r'You have 120 minutes.*?complete the exam',
+    r'You are not allowed.*?calculator.*?electronic device',
+    r'You are allowed to use.*?handwritten notes',
+    r'Please silence.*?electronic devices',
+    r'When you finish.*?120 minutes has elapsed',
+    r'When time is up.*?collect your exam',
+    r'Once you have completed.*?academic integrity statement',
+    r'Do NOT write in the grid.*?grading purposes only',
+    r'\\begin\{tabular\}.*?\\end\{tabular\}',
+    r'My signature below.*?Academic Integrity.*?examination paper',
+    r'Name \(printed\).*?Score.*?Signature.*?Date',
+    r'Problem.*?Points.*?Problem.*?Points',
+    r'\\hline.*?\\hline',
+    r'\\\\.*?\\\\',
+]), re.IGNORECASE | re.DOTALL)
+
+# Maps every character that re.IGNORECASE treats as an ASCII letter to that lowercase
+# letter, one character for one, so positions in the translated text match the original
+_ASCII_LOWERCASE = str.maketrans(
+    string.ascii_uppercase + '\u0130\u0131\u212a\u017f',  # also İ, ı, K (Kelvin), ſ
+    string.ascii_lowercase + 'iiks'
+)
+
+# Unescaped \( \) \[ \] LaTeX delimiters, rewritten to dollar signs
+_INLINE_OPEN_RE = re.compile(r'(?<!\\)\\(?!\\)\(')
+_INLINE_CLOSE_RE = re.compile(r'(?<!\\)\\(?!\\)\)')
+_DISPLAY_OPEN_RE = re.compile(r'(?<!\\)\\(?!\\)\[')
+_DISPLAY_CLOSE_RE = re.compile(r'(?<!\\)\\(?!\\)\]')
+
+
+@functools.cache
+def _creds():
+    """Return (MATHPIX_APP_ID, MATHPIX_APP_KEY), parsing .env only if the environment lacks them"""
+    
+    app_id = os.environ.get('MATHPIX_APP_ID')
+    app_key = os.environ.get('MATHPIX_APP_KEY')
+    
+    if not app_id or not app_key:
+        env_file = dotenv_values()
+        app_id = app_id or env_file.get('MATHPIX_APP_ID')
+        app_key = app_key or env_file.get('MATHPIX_APP_KEY')
+    
+    return app_id, app_key
+
+
+@functools.lru_cache(maxsize=None)
+def _subproblem_key_markers(key):
+    """Return the lowercase a), a. and (a) markers for a subproblem key, in search order"""
+    
+    key = key.lower()
+    return (f'{key})', f'{key}.', f'({key})')
+
+
+# Memoized: every detection pattern that finds a problem cleans the same text again,
+# and it is cleaned once more when the problem is built
+@functools.lru_cache(maxsize=4096)
+def _clean_text(text):
+    """Clean up extracted text"""
+    
+    # Remove page markers
+    text = _PAGE_MARKER_RE.sub('', text)
+    
+    # Normalize LaTeX delimiters to use dollar signs
+    text = _normalize_latex_delimiters(text)
+    
+    # HTML escape inequality symbols to prevent HTML parsing issues
+    text = _html_escape_math_symbols(text)
+    
+    # Remove common metadata patterns
+    text = _METADATA_RE.sub('', text)
+    
+    # Clean up whitespace
+    text = _WHITESPACE_RE.sub(' ', text)
+    
+    # Remove common artifacts
+    text = _LEADING_NUMBER_RE.sub('', text)  # Remove leading "1. "
+    
+    # Clean up excessive whitespace but preserve question marks at the end
+    text = text.strip()
+    # Don't strip question marks - they're important punctuation
+    
+    return text
+
+
+def _html_escape_math_symbols(text):
+    """Escape HTML special characters in mathematical expressions to prevent rendering issues"""
+    
+    # Replace < and > with HTML entities to prevent browser from interpreting them as HTML tags
+    # This is especially important for mathematical inequalities like "a<b<c"
+    text = text.replace('<', '&lt;')
+    text = text.replace('>', '&gt;')
+    
+    return text
+
+
+def _normalize_latex_delimiters(text):
+    """Normalize LaTeX delimiters to use dollar signs instead of \\( \\) and \\[ \\]"""
+    
+    if not text:
+        return text
+        
+    # Convert inline math delimiters: \( ... \) to $ ... $
+    # Match \( but not \\( (which is escaped)
+    text = _INLINE_OPEN_RE.sub('$', text)
+    text = _INLINE_CLOSE_RE.sub('$', text)
+    
+    # Convert display math delimiters: \[ ... \] to $$ ... $$
+    text = _DISPLAY_OPEN_RE.sub('$$', text)
+    text = _DISPLAY_CLOSE_RE.sub('$$', text)
+    
+    return text
+
+
+@functools.lru_cache(maxsize=4096)
+def _has_math_content(content):
+    """Check if page has substantial math content"""
+    
+    # Must have minimum length
+    if len(content.strip()) < 50:
+        return False
+    
+    found = set()
+    
+    # Math operators: deleting them shortens the string iff there are any
+    if len(content.translate(_STRIP_MATH_OPERATORS)) < len(content):
+        found.add('operator')
+    
+    # Other expressions in one scan, stopping as soon as two different kinds
+    # of indicator have turned up
+    for match in _MATH_EXPRESSION_RE.finditer(content):
+        found.add(match.lastgroup)
+        
+        # Must have at least 2 math indicators
+        if len(found) >= 2:
+            return True
+    
+    return False
 
 class SinglePDFConverter:
-    def __init__(self, app_id, app_key):
+    def __init__(self, app_id, app_key, max_concurrency=4, requests_per_second=2.0,
+                 cache_dir=DEFAULT_CACHE_DIR, dpi=DEFAULT_RENDER_DPI, verbose=True,
+                 use_text_layer=False, pdf_job_timeout=PDF_JOB_TIMEOUT):
         self.app_id = app_id
         self.app_key = app_key
         self.base_url = "https://api.mathpix.com/v3"
+        
+        # Print progress messages; per-page diagnostics go to the logger at DEBUG
+        self.verbose = verbose
+        
+        # Resolution pages are rendered at before OCR (raise it for PDFs with tiny fonts)
+        self.dpi = dpi
+        
+        # Parse PDFs with a good embedded text layer locally instead of OCR'ing them.
+        # Off by default: text-layer pages come out as plain text, without the LaTeX
+        # and $ delimiters or the cropped figures Mathpix returns
+        self.use_text_layer = use_text_layer
+        
+        # Seconds to wait for a /v3/pdf job before giving up on it
+        self.pdf_job_timeout = pdf_job_timeout
+        
+        # Mathpix results cached by page image or PDF hash (None disables the cache)
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        
+        # Number of page requests allowed in flight at once
+        self.max_concurrency = max_concurrency
+        
+        # One pooled session for every Mathpix call, so page requests reuse
+        # TCP/TLS connections instead of opening a new one each time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=max(16, max_concurrency))
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'app_id': app_id,
+            'app_key': app_key
+        })
+        
+        # Background writer for extracted images, created by convert_pdf for each
+        # conversion and shut down when it ends; convert_pdf waits on _pending_writes
+        # before it writes the JSON output
+        self._io_pool = None
+        self._pending_writes = []
+        
+        # Minimum spacing between Mathpix request starts, shared by all worker threads
+        self._request_interval = 1.0 / requests_per_second
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+        
+        # page_num -> (y positions, problem numbers) of problem starts in the PDF text layer
+        self._problem_positions = {}
+        
+        # page_num -> {xref: image rects on that page}
+        self._page_img_cache = {}
     
     def convert_pdf(self, pdf_path, output_dir="storage/processed", id_prefix=None):
         """Convert a single PDF to JSON with problems and images"""
         
-        print(f"🔄 Converting: {pdf_path}")
+        self._status(f"🔄 Converting: {pdf_path}")
         
-        # Store PDF path for image extraction
+        # Remember which PDF is being converted
         self.pdf_path = pdf_path
+        self._problem_positions = {}
+        self._page_img_cache = {}
+        
+        # Open the PDF once; rendering, text-layer reads and image extraction all share this handle
+        try:
+            self.pdf_doc = fitz.open(pdf_path)
+        except Exception as e:
+            logger.warning("❌ Could not open PDF %s: %s", pdf_path, e)
+            return None
+        
+        self._io_pool = ThreadPoolExecutor(max_workers=4)
+        self._pending_writes = []
+        try:
+            return self._convert_open_pdf(pdf_path, output_dir, id_prefix)
+        finally:
+            # Lets any writes still queued after a failure finish, then stops the threads
+            self._io_pool.shutdown()
+            self._io_pool = None
+            self._pending_writes = []
+            self.pdf_doc.close()
+            self.pdf_doc = None
+    
+    def _convert_open_pdf(self, pdf_path, output_dir, id_prefix):
+        """Body of convert_pdf, run while self.pdf_doc is open"""
         
         # Create output directory structure
         base_output_path = Path(output_dir)
@@ -45,33 +576,17 @@ class SinglePDFConverter:
         images_path = output_path / "images"
         images_path.mkdir(exist_ok=True)
         
-        # Step 1: Convert PDF to images (to handle large files)
-        print("📄 Converting PDF to images...")
-        page_images = self._pdf_to_images(pdf_path, output_path / "temp_pages")
+        # Step 1: OCR the PDF with Mathpix
+        page_results_stream = self._ocr_pdf(pdf_path)
         
-        if not page_images:
-            print("❌ Failed to convert PDF to images")
+        if page_results_stream is None:
             return None
         
-        print(f"✅ Created {len(page_images)} page images")
-        
-        # Step 2: Process each page with Mathpix
+        # Step 2: Extract problems and images from each page as its results arrive
         all_problems = []
         all_images = []
         
-        # Skip first few pages that typically contain headers/metadata
-        start_page = self._find_first_content_page(page_images)
-        
-        for page_num, page_image_path in enumerate(page_images, 1):
-            # Skip pages before content starts
-            if page_num < start_page:
-                print(f"⏭️  Skipping page {page_num} (header/metadata)")
-                continue
-                
-            print(f"🔍 Processing page {page_num}...")
-            
-            page_results = self._process_single_page(page_image_path, page_num)
-            
+        for page_num, page_results in page_results_stream:
             if page_results:
                 # Extract content and images from this page
                 page_problems, page_images_saved = self._extract_from_page_results(
@@ -79,12 +594,15 @@ class SinglePDFConverter:
                 )
                 all_problems.extend(page_problems)
                 all_images.extend(page_images_saved)
-            
-            # Small delay to avoid rate limiting
-            time.sleep(1)
+        
+        # Make sure every extracted image has reached disk before the JSON references it,
+        # and forget the ones that never did
+        failed_writes = self._wait_for_pending_writes()
+        if failed_writes:
+            all_images = [image for image in all_images if id(image) not in failed_writes]
         
         # Step 3: Combine and structure the data
-        print("🔧 Combining results...")
+        self._status("🔧 Combining results...")
         combined_problems = self._combine_page_results(all_problems, all_images, id_prefix)
         
         # Step 4: Save to JSON
@@ -110,75 +628,346 @@ class SinglePDFConverter:
             "problems": combined_problems
         }
         
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(final_data, f, indent=2, ensure_ascii=False)
-        
-        # Clean up temporary page images
-        self._cleanup_temp_files(output_path / "temp_pages")
+        # orjson serializes straight to UTF-8 bytes (non-ASCII kept as-is, like ensure_ascii=False)
+        json_file.write_bytes(orjson.dumps(final_data, option=orjson.OPT_INDENT_2))
         
-        print(f"✅ Conversion complete!")
-        print(f"📁 Problems saved to: {json_file}")
-        print(f"🖼️  Images saved to: {images_path}")
-        print(f"📊 Found {len(combined_problems)} problems")
+        self._status(f"✅ Conversion complete!")
+        self._status(f"📁 Problems saved to: {json_file}")
+        self._status(f"🖼️  Images saved to: {images_path}")
+        self._status(f"📊 Found {len(combined_problems)} problems")
         
         return str(json_file)
     
-    def _pdf_to_images(self, pdf_path, temp_dir):
-        """Convert PDF pages to images using PyMuPDF"""
+    def _status(self, message):
+        """Print a user-facing progress message when running verbosely"""
         
-        temp_path = Path(temp_dir)
-        temp_path.mkdir(exist_ok=True)
+        if self.verbose:
+            print(message)
+    
+    def _wait_for_pending_writes(self):
+        """Block until all queued image writes have finished.
         
-        page_images = []
+        Returns the ids of the image entries whose write failed.
+        """
+        
+        failed = set()
+        
+        for future, image_entry in self._pending_writes:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning("   ⚠️ Could not write image %s: %s", image_entry['filename'], e)
+                failed.add(id(image_entry))
+        
+        self._pending_writes = []
+        return failed
+    
+    def _ocr_pdf(self, pdf_path):
+        """OCR the PDF, returning an iterator of (page_num, page_results) for its content pages.
+        
+        PDFs with a substantial embedded text layer are read locally, with only their
+        scanned pages sent to Mathpix. Otherwise the whole document is sent to Mathpix
+        as a single /v3/pdf job, and if Mathpix rejects that job or reports an error,
+        pages are rendered to images and sent to /v3/text individually. A job that
+        times out is not redone page by page, since it is billed anyway. Returns None
+        if no route produced any pages.
+        """
+        
+        if self.use_text_layer:
+            text_layer = self._read_text_layer()
+            
+            if text_layer and sum(map(len, text_layer.values())) / len(text_layer) >= TEXT_LAYER_FAST_PATH_CHARS:
+                self._status(f"📄 Using the PDF's embedded text layer ({len(text_layer)} pages)")
+                
+                # Skip first few pages that typically contain headers/metadata
+                start_page = self._find_first_content_page(
+                    lambda page_num: {'text': text_layer[page_num]}, len(text_layer)
+                )
+                return self._iter_text_layer_page_results(text_layer, start_page)
+        
+        self._status("📤 Submitting PDF to Mathpix...")
+        page_results_by_num, job_ran = self._convert_pdf_whole(pdf_path)
+        
+        if page_results_by_num:
+            self._status(f"✅ Mathpix returned {len(page_results_by_num)} pages")
+            
+            # Skip first few pages that typically contain headers/metadata
+            start_page = self._find_first_content_page(
+                page_results_by_num.get, len(page_results_by_num)
+            )
+            return self._iter_pdf_page_results(page_results_by_num, start_page)
+        
+        # A job that is still running (or finished, but its results couldn't be fetched)
+        # is billed anyway, so don't pay again to OCR every page
+        if job_ran:
+            logger.warning("❌ Whole-PDF conversion did not finish; not re-sending every page to Mathpix")
+            return None
+        
+        logger.warning("⚠️ Whole-PDF conversion failed, falling back to page-by-page processing")
+        
+        # Convert PDF to images (to handle large files)
+        self._status("📄 Converting PDF to images...")
+        page_images = self._pdf_to_images()
+        
+        if not page_images:
+            logger.warning("❌ Failed to convert PDF to images")
+            return None
+        
+        self._status(f"✅ Created {len(page_images)} page images")
+        
+        # Skip first few pages that typically contain headers/metadata. The PDF's own
+        # text layer is free to read, so only scanned pages cost a Mathpix call here.
+        text_layer = self._read_text_layer(max_pages=3)
+        
+        def probe_page(page_num):
+            text = text_layer.get(page_num, '')
+            if len(text.strip()) >= MIN_TEXT_LAYER_CHARS:
+                return {'text': text}
+            return self._process_single_page(page_images[page_num - 1], page_num)
+        
+        start_page = self._find_first_content_page(probe_page, len(page_images))
+        return self._iter_image_page_results(page_images, start_page)
+    
+    def _iter_pdf_page_results(self, page_results_by_num, start_page):
+        """Yield (page_num, page_results) in page order from a completed /v3/pdf job"""
+        
+        for page_num in sorted(page_results_by_num):
+            # Skip pages before content starts
+            if page_num < start_page:
+                self._status(f"⏭️  Skipping page {page_num} (header/metadata)")
+                continue
+            
+            self._status(f"🔍 Processing page {page_num}...")
+            yield page_num, page_results_by_num[page_num]
+    
+    def _iter_image_page_results(self, page_images, start_page):
+        """Yield (page_num, page_results) in page order, OCR'ing page images with /v3/text"""
+        
+        # Mathpix calls are network-bound, so keep several pages in flight at once
+        # (throttled by _wait_for_rate_limit) and hand each result back in page order
+        # while later pages are still being OCR'd
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            pending_pages = []
+            for page_num, page_image in enumerate(page_images, 1):
+                # Skip pages before content starts
+                if page_num < start_page:
+                    self._status(f"⏭️  Skipping page {page_num} (header/metadata)")
+                    continue
+                
+                future = pool.submit(self._process_single_page, page_image, page_num)
+                pending_pages.append((page_num, future))
+            
+            for page_num, future in pending_pages:
+                self._status(f"🔍 Processing page {page_num}...")
+                yield page_num, future.result()
+    
+    def _iter_text_layer_page_results(self, text_layer, start_page):
+        """Yield (page_num, page_results) in page order from the PDF's text layer,
+        OCR'ing only the pages whose layer is empty or garbled"""
+        
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            pending_pages = []
+            for page_num in sorted(text_layer):
+                # Skip pages before content starts
+                if page_num < start_page:
+                    self._status(f"⏭️  Skipping page {page_num} (header/metadata)")
+                    continue
+                
+                text = text_layer[page_num]
+                if self._is_usable_text_layer(text):
+                    pending_pages.append((page_num, {'text': text}))
+                    continue
+                
+                # Scanned page: render just this one and send it to Mathpix
+                logger.debug("   Page %s has no usable text layer, sending it to Mathpix", page_num)
+                page_image = self._render_page(self.pdf_doc[page_num - 1])
+                pending_pages.append((page_num, pool.submit(self._process_single_page, page_image, page_num)))
+            
+            for page_num, page_results in pending_pages:
+                self._status(f"🔍 Processing page {page_num}...")
+                if not isinstance(page_results, dict):
+                    page_results = page_results.result()
+                yield page_num, page_results
+    
+    def _is_usable_text_layer(self, text):
+        """Check whether a page's embedded text is long enough and not mostly garbage"""
+        
+        text = text.strip()
+        if len(text) < MIN_TEXT_LAYER_CHARS:
+            return False
+        
+        non_ascii = len(text) - len(text.encode('ascii', 'ignore'))
+        return non_ascii / len(text) <= MAX_TEXT_LAYER_NON_ASCII
+    
+    def _convert_pdf_whole(self, pdf_path):
+        """Run the whole PDF through Mathpix's /v3/pdf endpoint as one job.
+        
+        Returns (page_results_by_num, job_ran). page_results_by_num is
+        {page_num: page_results}, each shaped like a /v3/text response, or None if
+        the job could not be completed. job_ran is True when Mathpix accepted the
+        job and didn't report an error, i.e. it was (or is still being) billed even
+        though its results aren't available, such as after a timeout.
+        """
+        
+        options = {
+            'math_inline_delimiters': ['$', '$'],
+            'math_display_delimiters': ['$$', '$$']
+        }
+        
+        pdf_id = None
         
         try:
-            # Open PDF
-            pdf_doc = fitz.open(pdf_path)
+            # Re-runs on the same PDF reuse the finished job's pages instead of paying for a new one
+            cache_file = None
+            if self.cache_dir:
+                cache_file = self.cache_dir / f"pdf_{self._file_sha256(pdf_path)}.json"
+                if cache_file.exists():
+                    cached_results = self._read_cache_file(cache_file)
+                    if cached_results is not None:
+                        self._status("   💾 Using cached Mathpix result for the whole PDF")
+                        # JSON object keys are strings; page numbers are ints everywhere else
+                        return {int(page_num): page_results for page_num, page_results in cached_results.items()}, True
+            
+            with open(pdf_path, 'rb') as f:
+                response = self.session.post(
+                    f"{self.base_url}/pdf",
+                    files={'file': f},
+                    data={'options_json': json.dumps(options)},
+                    timeout=120
+                )
+            
+            if response.status_code != 200 or 'pdf_id' not in response.json():
+                logger.warning("   ⚠️ Failed to submit PDF: %s", response.status_code)
+                return None, False
             
-            for page_num in range(pdf_doc.page_count):
-                page = pdf_doc[page_num]
+            pdf_id = response.json()['pdf_id']
+            
+            # Poll until Mathpix has finished every page
+            deadline = time.monotonic() + self.pdf_job_timeout
+            while True:
+                status_response = self.session.get(f"{self.base_url}/pdf/{pdf_id}", timeout=30)
+                status = status_response.json().get('status')
                 
-                # Convert to image with good resolution
-                mat = fitz.Matrix(2.0, 2.0)  # 2x scale for better quality
-                pix = page.get_pixmap(matrix=mat)
+                if status == 'completed':
+                    break
+                if status == 'error':
+                    logger.warning("   ⚠️ Mathpix reported an error for PDF %s", pdf_id)
+                    return None, False
+                if time.monotonic() > deadline:
+                    logger.warning("   ⚠️ Timed out waiting for PDF %s (last status: %s)", pdf_id, status)
+                    return None, True
                 
-                # Save as PNG
-                image_path = temp_path / f"page_{page_num + 1}.png"
-                pix.save(str(image_path))
-                page_images.append(str(image_path))
+                time.sleep(PDF_POLL_INTERVAL)
+            
+            lines_response = self.session.get(f"{self.base_url}/pdf/{pdf_id}.lines.json", timeout=60)
+            
+            if lines_response.status_code != 200:
+                logger.warning("   ⚠️ Failed to download results for PDF %s: %s", pdf_id, lines_response.status_code)
+                return None, True
+            
+            # Group the returned lines by page so each page can be parsed like a /v3/text result
+            page_results_by_num = {}
+            for page in lines_response.json().get('pages', []):
+                page_text = '\n'.join(line.get('text', '') for line in page.get('lines', []))
+                page_results_by_num[page['page']] = {'text': page_text}
+            
+            if cache_file and page_results_by_num:
+                self._write_cache_file(cache_file, page_results_by_num)
+            
+            return page_results_by_num, True
+            
+        except Exception as e:
+            logger.warning("   ⚠️ Error converting PDF with Mathpix: %s", e)
+            # Only a job Mathpix never accepted is safe to redo page by page
+            return None, pdf_id is not None
+    
+    def _file_sha256(self, path):
+        """Return the hex SHA-256 of a file, read in chunks so large PDFs aren't loaded at once"""
+        
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def _read_text_layer(self, max_pages=None):
+        """Return {page_num: text} from the PDF's embedded text layer (no OCR involved)"""
+        
+        text_layer = {}
+        
+        try:
+            page_count = self.pdf_doc.page_count
+            if max_pages is not None:
+                page_count = min(page_count, max_pages)
+            
+            for page_index in range(page_count):
+                text_layer[page_index + 1] = self.pdf_doc[page_index].get_text("text")
                 
-                print(f"   📄 Created page {page_num + 1} image")
+        except Exception as e:
+            logger.warning("⚠️ Could not read PDF text layer: %s", e)
+        
+        return text_layer
+    
+    def _pdf_to_images(self):
+        """Render PDF pages to in-memory (image_bytes, mime_type) pairs using PyMuPDF"""
+        
+        page_images = []
+        
+        try:
+            for page_num in range(self.pdf_doc.page_count):
+                page_images.append(self._render_page(self.pdf_doc[page_num]))
+                self._status(f"   📄 Created page {page_num + 1} image")
             
-            pdf_doc.close()
             return page_images
             
         except Exception as e:
-            print(f"❌ Error converting PDF to images: {e}")
+            logger.warning("❌ Error converting PDF to images: %s", e)
             return []
     
-    def _find_first_content_page(self, page_images):
-        """Find the first page that contains actual content (not headers/metadata)"""
+    def _render_page(self, page):
+        """Render one PDF page to an (image_bytes, mime_type) pair for OCR"""
+        
+        # Render at the configured DPI, but keep oversized pages to a sane pixel count
+        zoom = self.dpi / 72
+        zoom = min(zoom, MAX_RENDER_LONG_SIDE / max(page.rect.width, page.rect.height))
+        
+        # Text-dense pages OCR fine at lower resolution, and JPEG is far smaller than PNG.
+        # Only at the default DPI: a caller asking for more (tiny fonts, which are
+        # exactly the text-dense pages) gets the resolution they asked for
+        if self.dpi == DEFAULT_RENDER_DPI and len(page.get_text("text")) > TEXT_DENSE_PAGE_CHARS:
+            zoom = min(zoom, 1.5)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            return pix.tobytes("jpeg", jpg_quality=85), 'image/jpeg'
+        
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+        return pix.tobytes("png"), 'image/png'
+    
+    def _find_first_content_page(self, get_page_results, page_count):
+        """Find the first page that contains actual content (not headers/metadata)
+        
+        get_page_results(page_num) returns the Mathpix results for a page (or None).
+        """
         
         # Check first few pages to find where content starts
-        for i, image_path in enumerate(page_images[:3], 1):  # Check first 3 pages
+        for i in range(1, min(page_count, 3) + 1):  # Check first 3 pages
             try:
-                # Process the page to get text content
-                page_results = self._process_single_page(image_path, i)
+                # Get the page's text content
+                page_results = get_page_results(i)
                 
                 if page_results:
                     content = page_results.get('text', '') or page_results.get('latex', '')
                     
                     # Check if this page has substantial content
-                    if self._has_math_content(content) or self._contains_problem_numbers(content):
-                        print(f"✅ Content starts at page {i}")
+                    if _has_math_content(content) or self._contains_problem_numbers(content):
+                        self._status(f"✅ Content starts at page {i}")
                         return i
                         
             except Exception as e:
-                print(f"⚠️ Error checking page {i}: {e}")
+                logger.warning("⚠️ Error checking page %s: %s", i, e)
                 continue
         
         # Default to page 1 if we can't determine
-        print("⚠️ Could not determine content start page, using page 1")
+        logger.warning("⚠️ Could not determine content start page, using page 1")
         return 1
     
     def _contains_problem_numbers(self, content):
@@ -197,22 +986,36 @@ class SinglePDFConverter:
         
         return False
     
-    def _process_single_page(self, image_path, page_num):
-        """Process a single page image with Mathpix"""
+    def _wait_for_rate_limit(self):
+        """Block until this thread may start another Mathpix request"""
+        
+        with self._rate_lock:
+            now = time.monotonic()
+            delay = self._next_request_at - now
+            self._next_request_at = max(now, self._next_request_at) + self._request_interval
+        
+        if delay > 0:
+            time.sleep(delay)
+    
+    def _process_single_page(self, page_image, page_num):
+        """Process a single (image_bytes, mime_type) page image with Mathpix"""
         
         try:
-            # Read and encode image
-            with open(image_path, 'rb') as f:
-                image_data = base64.b64encode(f.read()).decode()
-            
-            headers = {
-                'app_id': self.app_id,
-                'app_key': self.app_key,
-                'Content-Type': 'application/json'
-            }
+            image_bytes, mime_type = page_image
+            
+            # Re-runs on the same PDF render identical page images, so answer those from disk
+            cache_file = None
+            if self.cache_dir:
+                cache_file = self.cache_dir / f"{hashlib.sha256(image_bytes).hexdigest()}.json"
+                if cache_file.exists():
+                    cached_results = self._read_cache_file(cache_file)
+                    if cached_results is not None:
+                        self._status(f"   💾 Using cached Mathpix result for page {page_num}")
+                        return cached_results
+            
+            self._wait_for_rate_limit()
             
-            payload = {
-                'src': f'data:image/png;base64,{image_data}',
+            options = {
                 'formats': ['latex', 'text'],
                 'format_options': {
                     'latex': {
@@ -222,23 +1025,55 @@ class SinglePDFConverter:
                 }
             }
             
-            response = requests.post(
+            # Upload the raw image as multipart/form-data rather than a base64 data URI
+            response = self.session.post(
                 f"{self.base_url}/text",  # Use text endpoint for images
-                headers=headers,
-                json=payload,
+                files={'file': (f'page_{page_num}.{mime_type.split("/")[1]}', image_bytes, mime_type)},
+                data={'options_json': json.dumps(options)},
                 timeout=60
             )
             
             if response.status_code == 200:
-                return response.json()
+                page_results = response.json()
+                if cache_file:
+                    self._write_cache_file(cache_file, page_results)
+                return page_results
             else:
-                print(f"   ⚠️ Failed to process page {page_num}: {response.status_code}")
+                logger.warning("   ⚠️ Failed to process page %s: %s", page_num, response.status_code)
                 return None
                 
         except Exception as e:
-            print(f"   ⚠️ Error processing page {page_num}: {e}")
+            logger.warning("   ⚠️ Error processing page %s: %s", page_num, e)
             return None
     
+    def _read_cache_file(self, cache_file):
+        """Load a cached Mathpix page result, or None if it can't be used
+        
+        A corrupt or truncated entry is deleted so the page is fetched (and cached) again.
+        """
+        
+        try:
+            return json.loads(cache_file.read_text(encoding='utf-8'))
+        except ValueError as e:
+            logger.warning("   ⚠️ Discarding corrupt cached Mathpix result %s: %s", cache_file.name, e)
+            cache_file.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning("   ⚠️ Could not read cached Mathpix result %s: %s", cache_file.name, e)
+        
+        return None
+    
+    def _write_cache_file(self, cache_file, page_results):
+        """Store a Mathpix page result in the on-disk cache"""
+        
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            # Write to a temp file first so a concurrent reader never sees a partial file
+            tmp_file = cache_file.with_name(f"{cache_file.name}.{threading.get_ident()}.tmp")
+            tmp_file.write_text(json.dumps(page_results), encoding='utf-8')
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            logger.warning("   ⚠️ Could not cache Mathpix result: %s", e)
+    
     def _extract_from_page_results(self, page_results, page_num, images_path):
         """Extract content and images from a single page result"""
         
@@ -264,8 +1099,11 @@ class SinglePDFConverter:
         if 'images' in page_results:
             # Skip Mathpix images if there are no problems on this page
             if not problem_boundaries or len(problem_boundaries) == 0:
-                print(f"   ⏭️ Page {page_num}: No problems found, skipping Mathpix images")
+                logger.debug("   ⏭️ Page %s: No problems found, skipping Mathpix images", page_num)
             else:
+                # Plain string paths; no Path object per saved image
+                images_dir = os.fspath(images_path)
+                
                 for img_idx, image_info in enumerate(page_results['images']):
                     # Try to determine which problem this image belongs to
                     associated_problem = self._find_image_problem_association(
@@ -279,19 +1117,21 @@ class SinglePDFConverter:
                         )
                     # Extract Mathpix images (they're less likely to be headers)
                     img_filename = self._save_image_from_results(
-                        image_info, images_path, page_num, img_idx + 1, associated_problem, associated_subproblem
+                        image_info, images_dir, page_num, img_idx + 1, associated_problem, associated_subproblem
                     )
                     if img_filename:
                         images_saved.append({
                             'filename': img_filename,
                             'page': page_num,
-                            'full_path': str(images_path / img_filename),
+                            'full_path': os.path.join(images_dir, img_filename),
                             'source': 'mathpix',
                             'associated_problem': associated_problem
                         })
         
-        # Also extract images directly from the PDF page for better graph detection
-        pdf_images = self._extract_images_from_pdf_page(page_num, images_path, problem_boundaries)
+        # Also extract images directly from the PDF page for better graph detection,
+        # skipping slots Mathpix already saved an image for
+        mathpix_stems = {os.path.splitext(img['filename'])[0] for img in images_saved}
+        pdf_images = self._extract_images_from_pdf_page(page_num, images_path, problem_boundaries, mathpix_stems)
         images_saved.extend(pdf_images)
         
         return problems, images_saved
@@ -301,25 +1141,24 @@ class SinglePDFConverter:
         
         boundaries = []
         
-        # Look for problem number patterns
-        patterns = [
-            r'(\d+)\.',  # "1."
-            r'Problem\s+(\d+)',  # "Problem 1"
-        ]
+        # Where the last accepted match of each marker ended; like separate finditer
+        # passes, a marker's matches never overlap each other
+        last_end = {'m0': 0, 'm1': 0}
         
-        for pattern in patterns:
-            for match in re.finditer(pattern, content):
-                problem_num = int(match.group(1))
-                position = match.start()
+        # Look for problem number patterns; the scan yields them in content order
+        for match in _BOUNDARY_RE.finditer(content):
+            for group, num_group in (('m0', 'num'), ('m1', 'problem_num')):
+                start = match.start(group)
+                if start < 0 or start < last_end[group]:
+                    continue
+                
+                last_end[group] = match.end(group)
                 boundaries.append({
-                    'problem_num': problem_num,
-                    'position': position,
-                    'match_text': match.group(0)
+                    'problem_num': int(match.group(num_group)),
+                    'position': start,
+                    'match_text': match.group(group)
                 })
         
-        # Sort by position in content
-        boundaries.sort(key=lambda x: x['position'])
-        
         return boundaries
 
     def _find_image_problem_association(self, img_idx, page_results, problem_boundaries):
@@ -340,19 +1179,19 @@ class SinglePDFConverter:
             return None
         
         # Debug: Print the Mathpix response structure to understand image positioning
-        print(f"   🔍 Debug: Analyzing image {img_idx} association")
-        print(f"   📄 Content length: {len(content)}")
-        print(f"   📊 Problem boundaries: {problem_boundaries}")
+        logger.debug("   🔍 Debug: Analyzing image %s association", img_idx)
+        logger.debug("   📄 Content length: %s", len(content))
+        logger.debug("   📊 Problem boundaries: %s", problem_boundaries)
         
         # Check if Mathpix provides image positioning information
         if 'images' in page_results and img_idx < len(page_results['images']):
             image_info = page_results['images'][img_idx]
-            print(f"   🖼️ Image info: {image_info}")
+            logger.debug("   🖼️ Image info: %s", image_info)
             
             # Look for position information in the image data
             if 'data' in image_info:
                 # Mathpix might include position hints in the image data or metadata
-                print(f"   📍 Image data available")
+                logger.debug("   📍 Image data available")
         
         # Try to find image references in the content
         # Mathpix sometimes includes image references in the text
@@ -371,72 +1210,70 @@ class SinglePDFConverter:
             for match in re.finditer(pattern, content, re.IGNORECASE):
                 image_positions.append(match.start())
         
-        print(f"   🎯 Found {len(image_positions)} image indicators in content")
+        logger.debug("   🎯 Found %s image indicators in content", len(image_positions))
         
         # If we found image positions, try to associate them with problems
         if image_positions and img_idx < len(image_positions):
             image_pos = image_positions[img_idx]
-            print(f"   📍 Image position: {image_pos}")
+            logger.debug("   📍 Image position: %s", image_pos)
             
             # Find which problem this image belongs to
             # An image belongs to the problem that comes immediately before it
-            for i, boundary in enumerate(problem_boundaries):
-                if boundary['position'] > image_pos:
-                    # This problem comes after the image, so the image belongs to the previous problem
-                    if i > 0:
-                        result = problem_boundaries[i - 1]['problem_num']
-                        print(f"   ✅ Associated image with problem {result}")
-                        return result
-                    else:
-                        # Image comes before the first problem
-                        print(f"   ⚠️ Image comes before first problem")
-                        return None
-                elif i == len(problem_boundaries) - 1:
-                    # Image comes after the last problem
-                    result = boundary['problem_num']
-                    print(f"   ✅ Associated image with last problem {result}")
-                    return result
+            boundary_positions = [boundary['position'] for boundary in problem_boundaries]
+            i = bisect.bisect_right(boundary_positions, image_pos)
+            if i == 0:
+                # Image comes before the first problem
+                logger.debug("   ⚠️ Image comes before first problem")
+                return None
+            
+            result = problem_boundaries[i - 1]['problem_num']
+            logger.debug("   ✅ Associated image with problem %s", result)
+            return result
         
         # Fallback: if we can't determine precise position, use a heuristic
         # For multiple problems on the same page, we need a better strategy
         if len(problem_boundaries) > 1:
             # If there are multiple problems, we need to be more careful
             # Let's try to use the order of images to determine association
-            print(f"   🔄 Multiple problems on page, using order-based association")
+            logger.debug("   🔄 Multiple problems on page, using order-based association")
             
             # For now, let's try a simple approach: associate first image with first problem
             # This is a temporary heuristic that needs improvement
             if img_idx == 0 and len(problem_boundaries) > 0:
                 result = problem_boundaries[0]['problem_num']
-                print(f"   ✅ Associated first image with first problem {result}")
+                logger.debug("   ✅ Associated first image with first problem %s", result)
                 return result
             elif img_idx == 1 and len(problem_boundaries) > 1:
                 result = problem_boundaries[1]['problem_num']
-                print(f"   ✅ Associated second image with second problem {result}")
+                logger.debug("   ✅ Associated second image with second problem %s", result)
                 return result
         
         # Final fallback: associate with the last problem found
         if len(problem_boundaries) > 0:
             result = problem_boundaries[-1]['problem_num']
-            print(f"   ⚠️ Fallback: Associated image with last problem {result}")
+            logger.debug("   ⚠️ Fallback: Associated image with last problem %s", result)
             return result
         
-        print(f"   ❌ Could not associate image with any problem")
+        logger.debug("   ❌ Could not associate image with any problem")
         return None
 
-    def _extract_images_from_pdf_page(self, page_num, images_path, problem_boundaries=None):
-        """Extract images directly from PDF page for better graph detection"""
+    def _extract_images_from_pdf_page(self, page_num, images_path, problem_boundaries=None, skip_stems=()):
+        """Extract images directly from PDF page for better graph detection
+        
+        skip_stems holds filenames (without extension) already saved for this page;
+        an extracted image that would get one of those names is not saved again.
+        """
         
         images_saved = []
         
         try:
             # Don't skip images completely if no problems found - they might be important
             if not problem_boundaries or len(problem_boundaries) == 0:
-                print(f"   ⚠️ Page {page_num}: No problems found, but still checking for images")
+                logger.debug("   ⚠️ Page %s: No problems found, but still checking for images", page_num)
                 # We'll still extract images but won't associate them with specific problems
             
-            # Open the original PDF
-            pdf_doc = fitz.open(self.pdf_path)  # We need to store pdf_path in the class
+            # Reuse the handle convert_pdf opened instead of re-parsing the PDF per page
+            pdf_doc = self.pdf_doc
             
             if page_num <= len(pdf_doc):
                 page = pdf_doc[page_num - 1]  # Convert to 0-based index
@@ -444,17 +1281,23 @@ class SinglePDFConverter:
                 # Get all images from this page
                 image_list = page.get_images()
                 
-                print(f"   🔍 PDF page {page_num}: Found {len(image_list)} images")
+                logger.debug("   🔍 PDF page %s: Found %s images", page_num, len(image_list))
                 if problem_boundaries:
-                    print(f"   📊 Problem boundaries on page {page_num}: {problem_boundaries}")
+                    logger.debug("   📊 Problem boundaries on page %s: %s", page_num, problem_boundaries)
+                
+                # How many times each xref has come up so far; an image drawn twice is
+                # listed once per placement, in the same order as its rects
+                xref_seen = defaultdict(int)
                 
                 for img_idx, img in enumerate(image_list):
                     try:
                         xref = img[0]
+                        occurrence = xref_seen[xref]
+                        xref_seen[xref] += 1
                         
                         # Check if this is a header image BEFORE processing (be more conservative)
-                        if self._is_header_image(pdf_doc, page_num, xref):
-                            print(f"   ⏭️ Skipped header image: {img_idx + 1}")
+                        if self._is_header_image(page_num, xref):
+                            logger.debug("   ⏭️ Skipped header image: %s", img_idx + 1)
                             continue
                         
                         pix = fitz.Pixmap(pdf_doc, xref)
@@ -467,7 +1310,7 @@ class SinglePDFConverter:
                             if problem_boundaries and len(problem_boundaries) > 0:
                                 # Use content-based association for better accuracy
                                 associated_problem = self._find_best_problem_for_image(
-                                    page_num, problem_boundaries, img_idx
+                                    page_num, problem_boundaries, img_idx, xref, occurrence
                                 )
                                 # Try to detect subproblem if we found a problem
                                 if associated_problem:
@@ -476,92 +1319,130 @@ class SinglePDFConverter:
                                     )
                             else:
                                 # No problem boundaries found, but still save the image
-                                print(f"   ⚠️ No problem boundaries on page {page_num}, saving image without association")
+                                logger.debug("   ⚠️ No problem boundaries on page %s, saving image without association", page_num)
+                            
+                            # Color figures compress far better (and faster) as WebP than PNG
+                            use_webp = pix.n - pix.alpha >= 3 and pix.width * pix.height >= WEBP_MIN_PIXELS
                             
                             # Create filename based on associated problem and subproblem
                             filename = self._generate_problem_based_filename(
-                                associated_problem, img_idx + 1, page_num, associated_subproblem
+                                associated_problem, img_idx + 1, page_num, associated_subproblem,
+                                ext='webp' if use_webp else 'png'
                             )
+                            
+                            # The same slot was already saved from the Mathpix results
+                            if os.path.splitext(filename)[0] in skip_stems:
+                                logger.debug("   ⏭️ Skipped PDF image %s: already saved from Mathpix", filename)
+                                continue
+                            
                             file_path = images_path / filename
                             
-                            # Save the image
-                            pix.save(str(file_path))
+                            # Leave the encode (for WebP) and the disk write to the I/O pool
+                            # so they overlap with the rest of the page processing
+                            if use_webp:
+                                mode = 'RGBA' if pix.alpha else 'RGB'
+                                future = self._io_pool.submit(
+                                    self._write_webp, file_path, mode, (pix.width, pix.height), pix.samples
+                                )
+                            else:
+                                image_bytes = pix.tobytes("png")
+                                future = self._io_pool.submit(file_path.write_bytes, image_bytes)
                             
-                            images_saved.append({
+                            image_entry = {
                                 'filename': filename,
                                 'page': page_num,
                                 'full_path': str(file_path),
                                 'source': 'pdf_direct',
                                 'associated_problem': associated_problem
-                            })
+                            }
+                            images_saved.append(image_entry)
+                            
+                            # Paired with its entry so a failed write can be dropped from the results
+                            self._pending_writes.append((future, image_entry))
                             
-                            print(f"   💾 Saved PDF image: {filename}")
+                            logger.debug("   💾 Saved PDF image: %s", filename)
                         
                         pix = None  # Free the pixmap
                         
                     except Exception as e:
-                        print(f"   ⚠️ Could not save PDF image {img_idx + 1}: {e}")
+                        logger.warning("   ⚠️ Could not save PDF image %s: %s", img_idx + 1, e)
                         continue
                 
-                pdf_doc.close()
-                
         except Exception as e:
-            print(f"   ⚠️ Error extracting PDF images from page {page_num}: {e}")
+            logger.warning("   ⚠️ Error extracting PDF images from page %s: %s", page_num, e)
         
         return images_saved
 
-    def _find_best_problem_for_image(self, page_num, problem_boundaries, img_idx):
-        """Find the best problem to associate with an image based on content analysis"""
+    def _write_webp(self, file_path, mode, size, samples):
+        """Encode raw pixmap samples as WebP and write them to file_path"""
         
-        # For now, use a simple heuristic based on problem order and content
-        # In a more sophisticated implementation, we could analyze the actual problem text
+        buffer = io.BytesIO()
+        Image.frombytes(mode, size, samples).save(buffer, format='WEBP', quality=WEBP_QUALITY)
+        file_path.write_bytes(buffer.getvalue())
+    
+    def _find_best_problem_for_image(self, page_num, problem_boundaries, img_idx, xref=None, occurrence=0):
+        """Find the best problem to associate with an image based on its position on the page
+        
+        occurrence says which placement of xref on the page this is, for an image
+        that is drawn more than once.
+        """
         
         if len(problem_boundaries) == 1:
             # Only one problem on this page
             associated_problem = problem_boundaries[0]['problem_num']
-            print(f"   ✅ Single problem on page: Associated with problem {associated_problem}")
+            logger.debug("   ✅ Single problem on page: Associated with problem %s", associated_problem)
             return associated_problem
         
         elif len(problem_boundaries) > 1:
-            # Multiple problems on page - need to be smarter
-            print(f"   🔄 Multiple problems on page {page_num}: Analyzing for best match")
-            
-            # For now, use a simple heuristic:
-            # - If there's only one image, associate with the problem that mentions "shaded region"
-            # - Otherwise, use order-based association
-            
-            # Check if any problem mentions image-related keywords
-            image_keywords = ['shaded region', 'graph', 'figure', 'diagram', 'plot']
-            
-            # For now, let's use a simple approach based on the problem numbers we know
-            if page_num == 6:
-                # Page 6 has problems 11, 12, 13
-                # Problem 11 mentions "shaded region", so associate image with problem 11
-                associated_problem = 11
-                print(f"   ✅ Page 6: Associated image with problem 11 (shaded region)")
-                return associated_problem
-            elif page_num == 7:
-                # Page 7 has problems 14, 15
-                # Problem 15 mentions "shaded region", so associate image with problem 15
-                associated_problem = 15
-                print(f"   ✅ Page 7: Associated image with problem 15 (shaded region)")
-                return associated_problem
-            else:
-                # Better heuristic: associate with the middle problem or second problem
-                # This works better for cases like calculus-solutions.pdf where the image
-                # belongs to problem 2 out of problems 1, 2, 3 on the same page
-                if len(problem_boundaries) >= 2:
-                    # Choose the second problem (index 1) as it's often the main problem with images
-                    associated_problem = problem_boundaries[1]['problem_num']
-                    print(f"   🎯 Multiple problems: Associated with second problem {associated_problem}")
-                else:
-                    # Fallback to first problem if there's only one
-                    associated_problem = problem_boundaries[0]['problem_num']
-                    print(f"   ⚠️ Fallback: Associated with first problem {associated_problem}")
-                return associated_problem
+            # Multiple problems on page: the image belongs to the nearest problem
+            # that starts above it in the PDF's own layout
+            if xref is not None:
+                ys, problem_nums = self._get_problem_positions(page_num, problem_boundaries)
+                rects = self._get_page_image_rects(page_num).get(xref)
+                
+                if ys and rects:
+                    rect = rects[min(occurrence, len(rects) - 1)]
+                    i = bisect.bisect_right(ys, rect.y0)
+                    if i > 0:
+                        associated_problem = problem_nums[i - 1]
+                        logger.debug("   ✅ Page %s: Image below problem %s", page_num, associated_problem)
+                        return associated_problem
+            
+            # No usable layout (scanned page, or image above every problem):
+            # fall back to the order heuristic. For cases like calculus-solutions.pdf
+            # the image belongs to problem 2 out of problems 1, 2, 3 on the same page
+            associated_problem = problem_boundaries[1]['problem_num']
+            logger.debug("   🎯 Multiple problems: Associated with second problem %s", associated_problem)
+            return associated_problem
         
         return None
     
+    def _get_problem_positions(self, page_num, problem_boundaries):
+        """Return sorted y positions and numbers of the page's problems in the PDF text layer.
+        
+        Only numbers that the OCR'd content also recognised as problem boundaries
+        are kept, so numbered list items and equations don't count as problems.
+        Cached per page, since every image on the page needs the same lookup.
+        """
+        
+        if page_num not in self._problem_positions:
+            known_problems = {boundary['problem_num'] for boundary in problem_boundaries}
+            starts = []
+            
+            for block in self.pdf_doc[page_num - 1].get_text("blocks"):
+                match = _BLOCK_PROBLEM_RE.match(block[4])
+                if match:
+                    problem_num = int(match.group('num') or match.group('problem_num'))
+                    if problem_num in known_problems:
+                        starts.append((block[1], problem_num))
+            
+            starts.sort()
+            self._problem_positions[page_num] = (
+                [y for y, _ in starts], [problem_num for _, problem_num in starts]
+            )
+        
+        return self._problem_positions[page_num]
+    
     def _parse_page_content(self, content, page_num):
         """Parse content from a single page"""
         
@@ -572,10 +1453,10 @@ class SinglePDFConverter:
         filtered_content = self._filter_page_content(content, page_num)
         
         if not filtered_content.strip():
-            print(f"   ⚠️ Page {page_num}: No content after filtering")
+            logger.debug("   ⚠️ Page %s: No content after filtering", page_num)
             return problems
         
-        print(f"   📄 Page {page_num}: Processing filtered content (length: {len(filtered_content)})")
+        logger.debug("   📄 Page %s: Processing filtered content (length: %s)", page_num, len(filtered_content))
         
         # Extract orphaned content (content before first problem number) for pages > 1
         if page_num > 1:
@@ -584,25 +1465,16 @@ class SinglePDFConverter:
                 # Store orphaned content to be associated with previous page's last problem
                 self.orphaned_content_by_page = getattr(self, 'orphaned_content_by_page', {})
                 self.orphaned_content_by_page[page_num] = orphaned_content
-                print(f"   🔗 Page {page_num}: Found orphaned content (length: {len(orphaned_content)})")
-        
-        # Look for problem patterns with improved detection
-        patterns = [
-            r'(?:^|\n)\s*(\d+)\.\s*(.+?)(?=(?:^|\n)\s*\d+\.\s|\Z)',  # "1. problem text" - more strict about line boundaries
-            r'(?:^|\n)\s*Problem\s+(\d+)[:\.]?\s*(.+?)(?=(?:^|\n)\s*Problem\s+\d+|\Z)',  # "Problem 1: text"
-            r'(?:^\d+\s+)?(\d+)\s+([A-Z][a-z]*(?:\s+[a-z]+)*?)\s+([a-z]\.\s+.*|Let\s+.*)',  # MIT format: "1 Title" + content, handles page numbers
-            r'(\d+)\.\s*(.+?)(?=\d+\.\s|\Z)',  # Simple: "1. text" without strict line boundaries
-            r'(\d+)\)\s*(.+?)(?=\d+\)\s|\Z)',  # "1) problem text"
-            r'(\d+)\s*[-–—]\s*(.+?)(?=\d+\s*[-–—]|\Z)',  # "1 - problem text" or "1 – problem text"
-        ]
+                logger.debug("   🔗 Page %s: Found orphaned content (length: %s)", page_num, len(orphaned_content))
         
         best_problems = []
         best_pattern_idx = -1
         
-        for pattern_idx, pattern in enumerate(patterns):
-            matches = list(re.finditer(pattern, filtered_content, re.DOTALL | re.IGNORECASE | re.MULTILINE))
+        # Look for problem patterns with improved detection
+        for pattern_idx, pattern in enumerate(_PROBLEM_PATTERNS):
+            matches = list(pattern.finditer(filtered_content))
             
-            print(f"   🔍 Page {page_num}: Pattern {pattern_idx + 1} found {len(matches)} matches")
+            logger.debug("   🔍 Page %s: Pattern %s found %s matches", page_num, pattern_idx + 1, len(matches))
             
             current_problems = []
             for match in matches:
@@ -616,11 +1488,11 @@ class SinglePDFConverter:
                 else:
                     problem_content = match.group(2).strip()
                 
-                print(f"   📝 Page {page_num}: Pattern {pattern_idx + 1} found problem {problem_num}, content length: {len(problem_content)}")
+                logger.debug("   📝 Page %s: Pattern %s found problem %s, content length: %s", page_num, pattern_idx + 1, problem_num, len(problem_content))
                 
                 # Validate problem number range (should be reasonable for exam problems)
                 if not self._is_valid_problem_number(problem_num):
-                    print(f"   ❌ Page {page_num}: Problem number {problem_num} out of valid range")
+                    logger.debug("   ❌ Page %s: Problem number %s out of valid range", page_num, problem_num)
                     continue
                 
                 # Validate problem content
@@ -629,12 +1501,12 @@ class SinglePDFConverter:
                         'page': page_num,
                         'number': problem_num,
                         'content': problem_content,
-                        'full_text': self._clean_text(problem_content)
+                        'full_text': _clean_text(problem_content)
                     }
                     current_problems.append(problem)
-                    print(f"   ✅ Page {page_num}: Added problem {problem_num}")
+                    logger.debug("   ✅ Page %s: Added problem %s", page_num, problem_num)
                 else:
-                    print(f"   ❌ Page {page_num}: Problem {problem_num} failed content validation")
+                    logger.debug("   ❌ Page %s: Problem %s failed content validation", page_num, problem_num)
             
             # Validate the sequence of problems found
             if current_problems and self._is_valid_problem_sequence(current_problems):
@@ -646,7 +1518,7 @@ class SinglePDFConverter:
                 
                 # If we're on page 5+ and finding problem numbers < 5, it's likely a false positive
                 if page_num >= 5 and max_problem_num < 5 and len(current_problems) > 1:
-                    print(f"   ⚠️ Page {page_num}: Pattern {pattern_idx + 1} found suspiciously low problem numbers {problem_numbers}")
+                    logger.debug("   ⚠️ Page %s: Pattern %s found suspiciously low problem numbers %s", page_num, pattern_idx + 1, problem_numbers)
                     continue
                 
                 # Prefer patterns that find more reasonable problems
@@ -670,15 +1542,15 @@ class SinglePDFConverter:
                 if is_better:
                     best_problems = current_problems
                     best_pattern_idx = pattern_idx
-                    print(f"   ✅ Page {page_num}: Pattern {pattern_idx + 1} gave better results ({len(current_problems)} problems)")
+                    logger.debug("   ✅ Page %s: Pattern %s gave better results (%s problems)", page_num, pattern_idx + 1, len(current_problems))
         
         problems = best_problems
         
         # Don't create page-level problems - only extract actual numbered problems
         if not problems:
-            print(f"   📄 Page {page_num}: No valid numbered problems found, skipping page")
+            logger.debug("   📄 Page %s: No valid numbered problems found, skipping page", page_num)
         else:
-            print(f"   📊 Page {page_num}: Using pattern {best_pattern_idx + 1}, returning {len(problems)} problems")
+            logger.debug("   📊 Page %s: Using pattern %s, returning %s problems", page_num, best_pattern_idx + 1, len(problems))
         
         return problems
     
@@ -736,71 +1608,10 @@ class SinglePDFConverter:
         """Filter out header/footer text and metadata"""
         
         # Remove common header/footer patterns
-        patterns_to_remove = [
-            r'Gstudocu.*?Studocu.*?university',
-            r'Downloaded by.*?@.*?\.com',
-            r'Scan to open on Studocu',
-            r'Studocu is not sponsored.*?university',
-            r'Introduction to Calculus.*?University of Pennsylvania',
-            r'103finalfall 2014 withans',
-            r'Page \d+ of \d+',
-            r'©.*?All rights reserved',
-            r'Confidential',
-            r'Draft',
-            r'Final Exam',
-            r'Name:.*?',
-            r'Student ID:.*?',
-            r'Date:.*?',
-            r'Time:.*?',
-            r'Instructions:.*?',
-            r'Total Points:.*?',
-            r'Show all work',
-            r'No calculators allowed',
-            r'Good luck',
-            # McGill header patterns
-            r'\)\s*Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
-            r'Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
-            # McGill exam instructions and metadata
-            r'Course:\s*MATH\s*\d+.*?Page number:\s*\d+\s*of\s*\d+',
-            r'INSTRUCTIONS\s*-\s*You have until.*?enjoy the summer!',
-            r'You have until.*?submit it on myCourses.*?No late submissions will be accepted',
-            r'All solutions should be your own.*?solve the problems',
-            r'Show and justify each step.*?simplify the answers',
-            r'You may answer the questions directly.*?single PDF file',
-            r'Stay safe and enjoy the summer!',
-            # Exam instructions and metadata
-            r'University of Pennsylvania.*?Math 103.*?Fall 2014',
-            r'Name.*?PRINT.*?Professor.*?Rimmer.*?Wong.*?Towsner',
-            r'Penn ID.*?Recitation Number.*?Rec\. Day.*?Rec\. Time',
-            r'This exam has.*?multiple choice questions.*?open-ended questions',
-            r'Each question is worth.*?points',
-            r'Partial credit will be given.*?supporting work',
-            r'correct answer with little or no supporting work.*?little or no credit',
-            r'Use the space provided.*?scrap paper is provided',
-            r'If you write on the back.*?indicate this in some way',
-            r'You have 120 minutes.*?complete the exam',
-            r'You are not allowed.*?calculator.*?electronic device',
-            r'You are allowed to use.*?handwritten notes',
-            r'Please silence.*?electronic devices',
-            r'When you finish.*?120 minutes has elapsed',
-            r'When time is up.*?collect your exam',
-            r'Once you have completed.*?academic integrity statement',
-            r'Do NOT write in the grid.*?grading purposes only',
-            r'\\begin\{tabular\}.*?\\end\{tabular\}',
-            r'My signature below.*?Academic Integrity.*?examination paper',
-            r'Name \(printed\).*?Score.*?Signature.*?Date',
-            r'Problem.*?Points.*?Problem.*?Points',
-            r'\\hline.*?\\hline',
-            r'\\\\.*?\\\\',
-        ]
-        
-        filtered_content = content
-        
-        for pattern in patterns_to_remove:
-            filtered_content = re.sub(pattern, '', filtered_content, flags=re.IGNORECASE | re.DOTALL)
+        filtered_content = _PAGE_FILTER_RE.sub('', content)
         
         # Remove excessive whitespace
-        filtered_content = re.sub(r'\s+', ' ', filtered_content)
+        filtered_content = _WHITESPACE_RE.sub(' ', filtered_content)
         
         return filtered_content.strip()
     
@@ -809,71 +1620,49 @@ class SinglePDFConverter:
         
         # Must have minimum length
         if len(content.strip()) < 20:
-            print(f"      ❌ Content too short: {len(content.strip())} chars")
+            logger.debug("      ❌ Content too short: %s chars", len(content.strip()))
             return False
         
-        # Must contain math-related content
-        math_indicators = [
-            r'\b(derivative|integral|limit|function|equation|solve|find|calculate|compute)\b',
-            r'[a-zA-Z]\([a-zA-Z]\)',  # f(x), g(y), etc.
-            r'[0-9]+\s*[+\-*/]\s*[0-9]+',  # Basic arithmetic
-            r'[a-zA-Z]\s*=\s*[a-zA-Z0-9+\-*/()]+',  # Variable assignments
-            r'[a-zA-Z]\^[0-9]+',  # x^2, y^3, etc.
-            r'\\frac\{.*?\}\{.*?\}',  # LaTeX fractions
-            r'\\sqrt\{.*?\}',  # LaTeX square roots
-            r'\\int',  # LaTeX integrals
-            r'\\lim',  # LaTeX limits
-        ]
-        
-        for pattern in math_indicators:
-            if re.search(pattern, content, re.IGNORECASE):
-                print(f"      ✅ Found math indicator: {pattern}")
+        # Most real problems contain one of a few literal tokens; a substring check
+        # accepts those without running any regex
+        for token in _FAST_MATH_TOKENS:
+            if token in content:
+                logger.debug("      ✅ Found math indicator: %s", token)
                 return True
         
-        # Removed multiple choice validation - these should not be valid subproblem content
+        # The remaining checks run case-sensitive patterns over one lowercased copy,
+        # cheapest first: a plain keyword alternation before the heavier indicator scans
+        content_lower = content.translate(_ASCII_LOWERCASE)
         
-        # Check for problem-solving keywords
-        problem_keywords = [
-            'find', 'solve', 'calculate', 'compute', 'determine', 'evaluate',
-            'prove', 'show', 'derive', 'integrate', 'differentiate'
-        ]
-        
-        for keyword in problem_keywords:
-            if keyword.lower() in content.lower():
-                print(f"      ✅ Found problem keyword: {keyword}")
-                return True
+        # Check for problem-solving keywords (one scan)
+        match = _PROBLEM_KEYWORD_RE.search(content_lower)
+        if match:
+            logger.debug("      ✅ Found problem keyword: %s", match.group(0))
+            return True
         
-        # Check for word problem indicators (real-world applications)
-        word_problem_indicators = [
-            r'\b(wishes|wants|needs|must|should|can|will)\b',  # Action words
-            r'\b(area|perimeter|volume|surface|length|width|height|distance)\b',  # Measurement words
-            r'\b(cost|price|money|dollars?|cents?)\b',  # Cost-related words
-            r'\b(rate|speed|time|hour|minute|second)\b',  # Rate/time words
-            r'\b(percent|percentage|ratio|proportion)\b',  # Ratio words
-            r'\b(rectangle|square|circle|triangle|shape)\b',  # Geometric shapes
-            r'\b(fence|build|construct|create|make)\b',  # Construction words
-            r'\b(optimize|minimize|maximize|least|most)\b',  # Optimization words
-        ]
+        # Must contain math-related content (one scan over all indicators)
+        match = _MATH_INDICATOR_RE.search(content_lower)
+        if match:
+            logger.debug("      ✅ Found math indicator: %s", match.group(0))
+            return True
         
-        for pattern in word_problem_indicators:
-            if re.search(pattern, content, re.IGNORECASE):
-                print(f"      ✅ Found word problem indicator: {pattern}")
-                return True
+        # Removed multiple choice validation - these should not be valid subproblem content
         
-        # Check for mathematical expressions in LaTeX
-        latex_math = [
-            r'\\mathrm\{.*?\}',  # \mathrm{text}
-            r'\\text\{.*?\}',    # \text{text}
-            r'[0-9]+\s*\\mathrm\{.*?\}',  # Numbers with units
-            r'\\[a-zA-Z]+\{.*?\}',  # Any LaTeX command
-        ]
+        # Check for word problem indicators (real-world applications)
+        match = _WORD_PROBLEM_RE.search(content_lower)
+        if match:
+            logger.debug("      ✅ Found word problem indicator (%s): %s", match.lastgroup, match.group(0))
+            return True
         
-        for pattern in latex_math:
-            if re.search(pattern, content, re.IGNORECASE):
-                print(f"      ✅ Found LaTeX math: {pattern}")
-                return True
+        # Check for mathematical expressions in LaTeX; every pattern needs a backslash,
+        # so a substring check rules them all out for plain text
+        if '\\' in content:
+            for pattern in _LATEX_MATH_PATTERNS:
+                if pattern.search(content_lower):
+                    logger.debug("      ✅ Found LaTeX math: %s", pattern.pattern)
+                    return True
         
-        print(f"      ❌ No math indicators found. Content preview: {content[:100]}...")
+        logger.debug("      ❌ No math indicators found. Content preview: %s...", content[:100])
         return False
     
     def _is_valid_subproblem_content(self, content):
@@ -884,88 +1673,54 @@ class SinglePDFConverter:
         
         # Must have minimum length (more lenient for subproblems)
         if len(cleaned_content.strip()) < 3:  # Very lenient for math expressions
-            print(f"      ❌ Subproblem content too short: {len(cleaned_content.strip())} chars")
+            logger.debug("      ❌ Subproblem content too short: %s chars", len(cleaned_content.strip()))
             return False
         
         # Must contain math-related content or problem-solving keywords
-        math_indicators = [
-            r'\b(derivative|integral|limit|function|equation|solve|find|calculate|compute|evaluate)\b',
-            r'[a-zA-Z]\([a-zA-Z]\)',  # f(x), g(y), etc.
-            r'[0-9]+\s*[+\-*/]\s*[0-9]+',  # Basic arithmetic
-            r'[a-zA-Z]\s*=\s*[a-zA-Z0-9+\-*/()]+',  # Variable assignments
-            r'[a-zA-Z]\^[0-9]+',  # x^2, y^3, etc.
-            r'\\frac\{.*?\}\{.*?\}',  # LaTeX fractions
-            r'\\sqrt\{.*?\}',  # LaTeX square roots
-            r'\\int',  # LaTeX integrals
-            r'\\lim',  # LaTeX limits
-            r'\\arcsin|\\arccos|\\arctan',  # LaTeX inverse trig functions
-            r'\\cosh|\\sinh|\\tanh',  # LaTeX hyperbolic functions
-            r'\\cos|\\sin|\\tan',  # LaTeX trig functions
-            r'\\log|\\ln|\\exp',  # LaTeX logarithmic functions
-            r'\\[a-zA-Z]+\s*\([^)]*\)',  # LaTeX functions with arguments
-        ]
-        
-        for pattern in math_indicators:
-            if re.search(pattern, cleaned_content, re.IGNORECASE):
-                print(f"      ✅ Found math indicator: {pattern}")
+        # (case-sensitive patterns over one lowercased copy)
+        cleaned_lower = cleaned_content.translate(_ASCII_LOWERCASE)
+        for pattern in _SUBPROBLEM_MATH_PATTERNS:
+            if pattern.search(cleaned_lower):
+                logger.debug("      ✅ Found math indicator: %s", pattern.pattern)
                 return True
         
-        # Check for problem-solving keywords
-        problem_keywords = [
-            'find', 'solve', 'calculate', 'compute', 'determine', 'evaluate',
-            'prove', 'show', 'derive', 'integrate', 'differentiate'
-        ]
-        
-        for keyword in problem_keywords:
-            if keyword.lower() in cleaned_content.lower():
-                print(f"      ✅ Found problem keyword: {keyword}")
-                return True
+        # Check for problem-solving keywords (one scan)
+        match = _PROBLEM_KEYWORD_RE.search(cleaned_lower)
+        if match:
+            logger.debug("      ✅ Found problem keyword: %s", match.group(0))
+            return True
         
         # Very lenient check for LaTeX expressions (even simple ones)
         if '\\(' in cleaned_content and '\\)' in cleaned_content:
-            print(f"      ✅ Found LaTeX expression delimiters")
+            logger.debug("      ✅ Found LaTeX expression delimiters")
             return True
         
         # Check for simple mathematical variables/expressions
-        if re.search(r'[a-zA-Z]', cleaned_content) and len(cleaned_content.strip()) >= 3:
-            print(f"      ✅ Contains mathematical variables (very lenient)")
+        if _LETTER_RE.search(cleaned_content) and len(cleaned_content.strip()) >= 3:
+            logger.debug("      ✅ Contains mathematical variables (very lenient)")
             return True
         
-        print(f"      ❌ No math indicators or keywords found in subproblem. Content: '{cleaned_content[:50]}...'")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("      ❌ No math indicators or keywords found in subproblem. Content: '%s...'", cleaned_content[:50])
         return False
     
     def _clean_subproblem_content(self, content):
         """Clean subproblem content by removing header patterns"""
         
         # Remove McGill header patterns specifically
-        header_patterns = [
-            r'\)\s*Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
-            r'Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
-        ]
-        
         cleaned = content
-        for pattern in header_patterns:
-            cleaned = re.sub(pattern, '', cleaned, flags=re.IGNORECASE)
+        for pattern in _SUBPROBLEM_HEADER_PATTERNS:
+            cleaned = pattern.sub('', cleaned)
         
         return cleaned.strip()
     
     def _indicates_subproblems_expected(self, content):
         """Check if the problem text indicates that subproblems should follow"""
         
-        indicators = [
-            r'find the following',
-            r'determine the following',
-            r'calculate the following',
-            r'evaluate the following',
-            r'compute the following',
-            r'solve the following',
-            r'show the following',
-            r'prove the following',
-        ]
-        
-        for indicator in indicators:
-            if re.search(indicator, content, re.IGNORECASE):
-                print(f"   🔍 Found subproblem indicator: '{indicator}'")
+        content = content.translate(_ASCII_LOWERCASE)
+        for indicator in _SUBPROBLEMS_EXPECTED_PATTERNS:
+            if indicator.search(content):
+                logger.debug("   🔍 Found subproblem indicator: '%s'", indicator.pattern)
                 return True
         
         return False
@@ -1014,11 +1769,11 @@ class SinglePDFConverter:
                 problem_text, solution = self._extract_solution(cleaned_sentence)
                 
                 subproblems[subproblem_key] = {
-                    "problem_text": self._clean_text(problem_text),
+                    "problem_text": _clean_text(problem_text),
                     "correct_answer": None,
                     "hint": None,
                     "solution": {
-                        "text": self._clean_text(solution) if solution else None,
+                        "text": _clean_text(solution) if solution else None,
                         "images": []
                     },
                     "images": [],
@@ -1026,7 +1781,7 @@ class SinglePDFConverter:
                 }
                 
                 subproblem_count += 1
-                print(f"   ✅ Extracted text-based subproblem {subproblem_key}: '{cleaned_sentence[:50]}...'")
+                logger.debug("   ✅ Extracted text-based subproblem %s: '%s...'", subproblem_key, cleaned_sentence[:50])
                 
                 # Limit to reasonable number of subproblems
                 if subproblem_count >= 6:
@@ -1076,69 +1831,38 @@ class SinglePDFConverter:
         
         return True
     
-    def _has_math_content(self, content):
-        """Check if page has substantial math content"""
-        
-        # Must have minimum length
-        if len(content.strip()) < 50:
-            return False
-        
-        # Check for math symbols and expressions
-        math_symbols = [
-            r'[+\-*/=<>≤≥≠≈]',  # Math operators
-            r'[a-zA-Z]\s*[+\-*/]\s*[a-zA-Z]',  # Variable operations
-            r'[0-9]+\s*[+\-*/]\s*[0-9]+',  # Numbers with operators
-            r'[a-zA-Z]\([a-zA-Z]\)',  # Function notation
-            r'[a-zA-Z]\^[0-9]+',  # Exponents
-            r'\\[a-zA-Z]+\{.*?\}',  # LaTeX commands
-        ]
-        
-        math_count = 0
-        for pattern in math_symbols:
-            if re.search(pattern, content):
-                math_count += 1
-        
-        # Must have at least 2 math indicators
-        return math_count >= 2
-    
     def _combine_page_results(self, all_problems, all_images, id_prefix=None):
         """Combine problems from all pages into final format"""
         
         combined_problems = []
         
         # Group problems by problem number and track their pages
-        problems_by_number = {}
+        problems_by_number = defaultdict(list)
         for problem in all_problems:
-            num = problem['number']
-            if num not in problems_by_number:
-                problems_by_number[num] = []
-            problems_by_number[num].append(problem)
+            problems_by_number[problem['number']].append(problem)
         
         # Associate orphaned content with problems
         self._associate_orphaned_content_with_problems(problems_by_number)
         
         # Create final problem objects
-        for problem_num in sorted(problems_by_number.keys()):
-            problem_parts = problems_by_number[problem_num]
+        for problem_num in sorted(problems_by_number):
+            # Order the parts by page once; the stable sort keeps same-page parts in
+            # their original order
+            problem_parts = sorted(problems_by_number[problem_num], key=itemgetter('page'))
             
             # Get all pages this problem appears on
             problem_pages = [p['page'] for p in problem_parts]
             
-            # Find the primary page (the one with the actual problem, not answer key)
-            # Usually the first occurrence is the actual problem
-            primary_problem = problem_parts[0]  # Use the first occurrence
-            
-            # If there are multiple pages, try to identify which one is the actual problem
+            # The primary part (the actual problem, not answer key) is the one on the
+            # earliest page, since the problem statement usually comes first
             if len(problem_parts) > 1:
-                # Choose the earliest page (problem statement usually comes first, not last)
-                primary_problem = min(problem_parts, key=lambda p: p['page'])
-                print(f"   🔍 Problem {problem_num}: Using content from page {primary_problem['page']} (earliest page, length: {len(primary_problem['content'])})")
+                primary_problem = problem_parts[0]
+                logger.debug("   🔍 Problem %s: Using content from page %s (earliest page, length: %s)", problem_num, primary_problem['page'], len(primary_problem['content']))
             
             # Combine content from all pages in order (to handle multi-page problems/solutions)
-            problem_parts_sorted = sorted(problem_parts, key=lambda p: p['page'])
-            combined_content = '\n'.join([part['content'] for part in problem_parts_sorted])
+            combined_content = '\n'.join([part['content'] for part in problem_parts])
             
-            print(f"   📄 Problem {problem_num}: Combined content from {len(problem_parts)} page(s), total length: {len(combined_content)}")
+            logger.debug("   📄 Problem %s: Combined content from %s page(s), total length: %s", problem_num, len(problem_parts), len(combined_content))
             
             # Extract subproblems from the content
             subproblems = self._extract_subproblems(combined_content)
@@ -1177,12 +1901,12 @@ class SinglePDFConverter:
             final_problem = {
                 "id": problem_id,
                 "doc_id": id_prefix if id_prefix else "unknown",
-                "problem_text": self._clean_text(main_problem_text),
+                "problem_text": _clean_text(main_problem_text),
                 "subproblems": subproblems_with_images,
                 "correct_answer": None,
                 "hint": None,
                 "solution": {
-                    "text": self._clean_text(main_solution) if main_solution else None,
+                    "text": _clean_text(main_solution) if main_solution else None,
                     "images": solution_images  # For solution-specific images
                 },
                 "images": main_images,
@@ -1232,12 +1956,12 @@ class SinglePDFConverter:
                     'page': page_num,
                     'number': last_problem_num,
                     'content': orphaned_content,
-                    'full_text': self._clean_text(orphaned_content),
+                    'full_text': _clean_text(orphaned_content),
                     'is_continuation': True
                 }
                 
                 problems_by_number[last_problem_num].append(orphaned_part)
-                print(f"   🔗 Associated orphaned content from page {page_num} with problem {last_problem_num}")
+                logger.debug("   🔗 Associated orphaned content from page %s with problem %s", page_num, last_problem_num)
         
     def _save_image_from_results(self, image_info, images_path, page_num, img_num, associated_problem=None, associated_subproblem=None):
         """Save image from Mathpix results"""
@@ -1248,35 +1972,35 @@ class SinglePDFConverter:
             
             image_b64 = image_info['data']
             if image_b64.startswith('data:image'):
-                image_b64 = image_b64.split(',')[1]
-            
-            image_bytes = base64.b64decode(image_b64)
+                # Slice off the "data:image/...;base64," prefix without splitting the payload
+                image_b64 = image_b64[image_b64.index(',') + 1:]
+            if _NON_BASE64_RE.search(image_b64):
+                image_b64 = _NON_BASE64_RE.sub('', image_b64)
             
             filename = self._generate_problem_based_filename(
                 associated_problem, img_num, page_num, associated_subproblem
             )
-            file_path = images_path / filename
-            
-            with open(file_path, 'wb') as f:
-                f.write(image_bytes)
+            file_path = os.path.join(os.fspath(images_path), filename)
             
-            print(f"   💾 Saved image: {filename}")
+            # Decode and write in aligned chunks so the whole decoded image is never
+            # held in memory next to its base64 text
+            try:
+                with open(file_path, 'wb') as f:
+                    for start in range(0, len(image_b64), BASE64_CHUNK_CHARS):
+                        f.write(binascii.a2b_base64(image_b64[start:start + BASE64_CHUNK_CHARS]))
+            except Exception:
+                # Don't leave a truncated image behind
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                raise
+            
+            logger.debug("   💾 Saved image: %s", filename)
             return filename
             
         except Exception as e:
-            print(f"   ⚠️ Could not save image: {e}")
+            logger.warning("   ⚠️ Could not save image: %s", e)
             return None
     
-    def _cleanup_temp_files(self, temp_dir):
-        """Clean up temporary page images"""
-        try:
-            import shutil
-            if Path(temp_dir).exists():
-                shutil.rmtree(temp_dir)
-                print("🗑️  Cleaned up temporary files")
-        except Exception as e:
-            print(f"⚠️ Could not clean up temp files: {e}")
-    
     def _extract_subproblems(self, content):
         """Extract subproblems from a single problem's content.
         
@@ -1292,41 +2016,36 @@ class SinglePDFConverter:
         # Find all potential subproblem markers
         subproblem_markers = []
         
-        # Pattern to match subproblem markers with context
-        patterns = [
-            # a) format - look for letter followed by closing parenthesis
-            r'([a-zA-Z])\)',
-            # a. format - look for letter followed by period  
-            r'([a-zA-Z])\.',
-            # (a) format - look for letter inside parentheses
-            r'\(([a-zA-Z])\)',
-            # i) format - roman numerals
-            r'([iv]+)\)',
-            # 1) format - numbers followed by parenthesis
-            r'(\d+)\)',
-        ]
-        
-        for pattern_idx, pattern in enumerate(patterns):
-            pattern_name = ['a)', 'a.', '(a)', 'i)', '1)'][pattern_idx]
-            
-            for match in re.finditer(pattern, content, re.MULTILINE):
-                key = match.group(1).lower()
-                marker_text = match.group(0)  # Full matched text (e.g., "a)", "b.", "(c)")
+        # Which positions fall inside a LaTeX expression, worked out in one pass
+        in_latex = self._latex_context_mask(content)
+        
+        # Collect candidate markers for every format in one scan. A format's matches
+        # never overlap each other, so a match starting inside the previous one is dropped
+        format_count = len(_SUBPROBLEM_MARKER_FORMATS)
+        candidates = [[] for _ in range(format_count)]
+        format_ends = [0] * format_count
+        
+        for match in _SUBPROBLEM_MARKER_RE.finditer(content):
+            for i in range(format_count):
+                marker_start, marker_end = match.span(f'm{i}')
+                if marker_start >= format_ends[i]:
+                    format_ends[i] = marker_end
+                    candidates[i].append(match)
+        
+        # Starts of accepted markers, kept sorted for the duplicate check
+        accepted_starts = []
+        
+        # Check context format by format, so earlier formats win position clashes
+        for i, (pattern_name, _) in enumerate(_SUBPROBLEM_MARKER_FORMATS):
+            for match in candidates[i]:
+                key = match.group(f'k{i}').lower()
+                marker_text = match.group(f'm{i}')  # Full matched text (e.g., "a)", "b.", "(c)")
                 
                 # Get the actual marker position
-                marker_start = match.start()
-                marker_end = match.end()
-                
-                # Check if this marker is inside a LaTeX expression
-                before_marker = content[:marker_start]
-                
-                # Count unclosed LaTeX delimiters before this position
-                open_inline = before_marker.count('\\(') - before_marker.count('\\)')
-                open_display = before_marker.count('\\[') - before_marker.count('\\]')
-                open_dollar = before_marker.count('$') % 2  # Odd means we're inside $ $
+                marker_start, marker_end = match.span(f'm{i}')
                 
                 # Skip if we're inside any LaTeX expression
-                if open_inline > 0 or open_display > 0 or open_dollar == 1:
+                if in_latex[marker_start]:
                     continue
                 
                 # Check if marker is in proper context
@@ -1351,14 +2070,12 @@ class SinglePDFConverter:
                 # Use the exact match positions 
                 actual_start = marker_start
                 
-                # Avoid duplicates - check if we already found this position
-                duplicate = False
-                for existing in subproblem_markers:
-                    if abs(existing['start'] - actual_start) < 3:  # Within 3 characters
-                        duplicate = True
-                        break
+                # Avoid duplicates - skip markers within 3 characters of one already found
+                j = bisect.bisect_left(accepted_starts, actual_start - 2)
+                duplicate = j < len(accepted_starts) and accepted_starts[j] <= actual_start + 2
                 
                 if not duplicate:
+                    accepted_starts.insert(j, actual_start)
                     subproblem_markers.append({
                         'key': key,
                         'start': actual_start,
@@ -1374,17 +2091,20 @@ class SinglePDFConverter:
         
         # Check if this looks like multiple choice options (exclude them completely)
         if self._is_multiple_choice_sequence(subproblem_markers):
-            print(f"   🚫 Detected multiple choice options - excluding from subproblems")
+            logger.debug("   🚫 Detected multiple choice options - excluding from subproblems")
             return {}
         
         # Special handling for problems that indicate subproblems but none were found
         if not subproblem_markers and self._indicates_subproblems_expected(content):
-            print(f"   🔍 Problem indicates subproblems expected but none found with standard patterns")
+            logger.debug("   🔍 Problem indicates subproblems expected but none found with standard patterns")
             # Try to extract text-based subproblems
             text_subproblems = self._extract_text_based_subproblems(content)
             if text_subproblems:
                 return text_subproblems
         
+        # Checked once, so the raw-content preview isn't sliced for every subproblem unless logged
+        debug = logger.isEnabledFor(logging.DEBUG)
+        
         # Extract subproblem content between markers
         for i, marker in enumerate(subproblem_markers):
             start_pos = marker['end']  # Start after the marker (e.g., after "a)")
@@ -1401,10 +2121,11 @@ class SinglePDFConverter:
             subproblem_content = content[start_pos:end_pos].strip()
             
             # Remove any trailing newlines and clean up
-            subproblem_content = re.sub(r'\n\s*$', '', subproblem_content)
+            subproblem_content = _TRAILING_NEWLINES_RE.sub('', subproblem_content)
             subproblem_content = subproblem_content.strip()
             
-            print(f"   🔍 Raw subproblem {marker['key']} content: '{subproblem_content[:100]}...'")
+            if debug:
+                logger.debug("   🔍 Raw subproblem %s content: '%s...'", marker['key'], subproblem_content[:100])
             
             # Basic validation for subproblem content (more lenient than main problems)
             if self._is_valid_subproblem_content(subproblem_content):
@@ -1415,25 +2136,64 @@ class SinglePDFConverter:
                 problem_text, solution = self._extract_solution(cleaned_subproblem_content)
                 
                 subproblems[marker['key']] = {
-                    "problem_text": self._clean_text(problem_text),
+                    "problem_text": _clean_text(problem_text),
                     "correct_answer": None,
                     "hint": None,
                     "solution": {
-                        "text": self._clean_text(solution) if solution else None,
+                        "text": _clean_text(solution) if solution else None,
                         "images": []  # For solution-specific images
                     },
                     "images": [],
                     "comment": None
                 }
                 if solution:
-                    print(f"   ✅ Extracted subproblem {marker['key']} with solution")
+                    logger.debug("   ✅ Extracted subproblem %s with solution", marker['key'])
                 else:
-                    print(f"   ✅ Extracted subproblem {marker['key']}")
+                    logger.debug("   ✅ Extracted subproblem %s", marker['key'])
             else:
-                print(f"   ⚠️ Subproblem {marker['key']} failed validation")
+                logger.debug("   ⚠️ Subproblem %s failed validation", marker['key'])
         
         return subproblems
     
+    def _latex_context_mask(self, content):
+        """Return a bytearray with a 1 at every position of content that is inside LaTeX.
+        
+        A position is inside LaTeX when the text before it has more \\( than \\),
+        more \\[ than \\], or an odd number of $. Only the delimiters themselves are
+        visited (found by one regex scan), and each stretch of text between them
+        is filled in with a single slice assignment.
+        """
+        
+        in_latex = bytearray(len(content))
+        open_inline = open_display = dollars = 0
+        inside_since = None
+        
+        for match in _LATEX_DELIMITER_RE.finditer(content):
+            delimiter = match.group()
+            if delimiter == '$':
+                dollars += 1
+            elif delimiter == '\\(':
+                open_inline += 1
+            elif delimiter == '\\)':
+                open_inline -= 1
+            elif delimiter == '\\[':
+                open_display += 1
+            else:
+                open_display -= 1
+            
+            # The new counts apply from the end of this delimiter onwards
+            inside = open_inline > 0 or open_display > 0 or dollars % 2
+            if inside and inside_since is None:
+                inside_since = match.end()
+            elif not inside and inside_since is not None:
+                in_latex[inside_since:match.end()] = b'\x01' * (match.end() - inside_since)
+                inside_since = None
+        
+        if inside_since is not None:
+            in_latex[inside_since:] = b'\x01' * (len(content) - inside_since)
+        
+        return in_latex
+    
     def _is_multiple_choice_sequence(self, markers):
         """Detect if markers represent multiple choice options rather than real subproblems"""
         if len(markers) < 4:  # Multiple choice typically has 4+ options
@@ -1447,7 +2207,7 @@ class SinglePDFConverter:
         
         # If we have 4+ sequential letters starting from 'a', it's likely multiple choice
         if keys == expected_sequence:
-            print(f"   🔍 Sequential pattern detected: {keys}")
+            logger.debug("   🔍 Sequential pattern detected: %s", keys)
             return True
         
         # Also check if we have 4+ letters that are mostly sequential (allowing some gaps)
@@ -1464,7 +2224,7 @@ class SinglePDFConverter:
             
             # If the range spans 4+ positions and we have 4+ items, likely multiple choice
             if letter_nums[-1] - letter_nums[0] >= 3 and len(letter_nums) >= 4:
-                print(f"   🔍 Multiple choice pattern detected: {keys}")
+                logger.debug("   🔍 Multiple choice pattern detected: %s", keys)
                 return True
         
         return False
@@ -1513,121 +2273,6 @@ class SinglePDFConverter:
         
         return descriptive_id
     
-    def _clean_text(self, text):
-        """Clean up extracted text"""
-        
-        # Remove page markers
-        text = re.sub(r'--- PAGE \d+ ---', '', text)
-        
-        # Normalize LaTeX delimiters to use dollar signs
-        text = self._normalize_latex_delimiters(text)
-        
-        # HTML escape inequality symbols to prevent HTML parsing issues
-        text = self._html_escape_math_symbols(text)
-        
-        # Remove common metadata patterns
-        metadata_patterns = [
-            r'Gstudocu.*?Studocu.*?university',
-            r'Downloaded by.*?@.*?\.com',
-            r'Scan to open on Studocu',
-            r'Studocu is not sponsored.*?university',
-            r'Introduction to Calculus.*?University of Pennsylvania',
-            r'103finalfall 2014 withans',
-            r'Page \d+ of \d+',
-            r'©.*?All rights reserved',
-            r'Confidential',
-            r'Draft',
-            r'Final Exam',
-            r'Name:.*?',
-            r'Student ID:.*?',
-            r'Date:.*?',
-            r'Time:.*?',
-            r'Instructions:.*?',
-            r'Total Points:.*?',
-            r'Show all work',
-            r'No calculators allowed',
-            r'Good luck',
-            r'jeremywu12345@gmail\.com',
-            r'jeremywu12345',
-            # McGill header patterns
-            r'\)\s*Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
-            r'Winter\s+\d{4}\s+MATH\s+\d+\s+V\d+,\s+P\d+(?:\s+Question)?',
-            # McGill exam instructions and metadata
-            r'Course:\s*MATH\s*\d+.*?Page number:\s*\d+\s*of\s*\d+',
-            r'INSTRUCTIONS\s*-\s*You have until.*?enjoy the summer!',
-            r'You have until.*?submit it on myCourses.*?No late submissions will be accepted',
-            r'All solutions should be your own.*?solve the problems',
-            r'Show and justify each step.*?simplify the answers',
-            r'You may answer the questions directly.*?single PDF file',
-            r'Stay safe and enjoy the summer!',
-            # Exam instructions and metadata
-            r'University of Pennsylvania.*?Math 103.*?Fall 2014',
-            r'Name.*?PRINT.*?Professor.*?Rimmer.*?Wong.*?Towsner',
-            r'Penn ID.*?Recitation Number.*?Rec\. Day.*?Rec\. Time',
-            r'This exam has.*?multiple choice questions.*?open-ended questions',
-            r'Each question is worth.*?points',
-            r'Partial credit will be given.*?supporting work',
-            r'correct answer with little or no supporting work.*?little or no credit',
-            r'Use the space provided.*?scrap paper is provided',
-            r'If you write on the back.*?indicate this in some way',
-            r'You have 120 minutes.*?complete the exam',
-            r'You are not allowed.*?calculator.*?electronic device',
-            r'You are allowed to use.*?handwritten notes',
-            r'Please silence.*?electronic devices',
-            r'When you finish.*?120 minutes has elapsed',
-            r'When time is up.*?collect your exam',
-            r'Once you have completed.*?academic integrity statement',
-            r'Do NOT write in the grid.*?grading purposes only',
-            r'\\begin\{tabular\}.*?\\end\{tabular\}',
-            r'My signature below.*?Academic Integrity.*?examination paper',
-            r'Name \(printed\).*?Score.*?Signature.*?Date',
-            r'Problem.*?Points.*?Problem.*?Points',
-            r'\\hline.*?\\hline',
-            r'\\\\.*?\\\\',
-        ]
-        
-        for pattern in metadata_patterns:
-            text = re.sub(pattern, '', text, flags=re.IGNORECASE | re.DOTALL)
-        
-        # Clean up whitespace
-        text = re.sub(r'\s+', ' ', text)
-        
-        # Remove common artifacts
-        text = re.sub(r'^\s*\d+\.\s*', '', text)  # Remove leading "1. "
-        
-        # Clean up excessive whitespace but preserve question marks at the end
-        text = text.strip()
-        # Don't strip question marks - they're important punctuation
-        
-        return text
-    
-    def _html_escape_math_symbols(self, text):
-        """Escape HTML special characters in mathematical expressions to prevent rendering issues"""
-        
-        # Replace < and > with HTML entities to prevent browser from interpreting them as HTML tags
-        # This is especially important for mathematical inequalities like "a<b<c"
-        text = text.replace('<', '&lt;')
-        text = text.replace('>', '&gt;')
-        
-        return text
-    
-    def _normalize_latex_delimiters(self, text):
-        """Normalize LaTeX delimiters to use dollar signs instead of \\( \\) and \\[ \\]"""
-        
-        if not text:
-            return text
-            
-        # Convert inline math delimiters: \( ... \) to $ ... $
-        # Match \( but not \\( (which is escaped)
-        text = re.sub(r'(?<!\\)\\(?!\\)\(', '$', text)
-        text = re.sub(r'(?<!\\)\\(?!\\)\)', '$', text)
-        
-        # Convert display math delimiters: \[ ... \] to $$ ... $$
-        text = re.sub(r'(?<!\\)\\(?!\\)\[', '$$', text)
-        text = re.sub(r'(?<!\\)\\(?!\\)\]', '$$', text)
-        
-        return text
-
     def _clean_problem_text(self, content, subproblems):
         """Clean up the problem text by removing subproblem parts."""
         cleaned_text = content
@@ -1637,28 +2282,22 @@ class SinglePDFConverter:
             # Find the first subproblem marker in the content
             first_marker_pos = len(cleaned_text)  # Start with end of content
             
+            # Markers are matched case-insensitively; keys are ASCII, so folding
+            # ASCII letters is enough and keeps every position where it was
+            lowered_text = cleaned_text.translate(_ASCII_LOWERCASE)
+            
             for subproblem_key in subproblems.keys():
-                # Look for different subproblem marker patterns:
-                # 1. a) format
-                pattern1 = rf'(^|\s){re.escape(subproblem_key)}\)'
-                # 2. a. format  
-                pattern2 = rf'(^|\s){re.escape(subproblem_key)}\.'
-                # 3. (a) format
-                pattern3 = rf'(^|\s)\({re.escape(subproblem_key)}\)'
-                
-                # Try each pattern
-                for pattern in [pattern1, pattern2, pattern3]:
-                    match = re.search(pattern, cleaned_text, re.IGNORECASE | re.MULTILINE)
+                # Try the a), a. and (a) marker formats in turn
+                for marker in _subproblem_key_markers(subproblem_key):
+                    # A marker only counts at the start of the text or after whitespace
+                    marker_pos = lowered_text.find(marker)
+                    while marker_pos > 0 and not lowered_text[marker_pos - 1].isspace():
+                        marker_pos = lowered_text.find(marker, marker_pos + 1)
                     
-                    if match:
-                        # Get the position of the actual marker (not the leading whitespace)
-                        marker_pos = match.start()
-                        if match.group(1):  # If there was leading whitespace/newline
-                            marker_pos = match.start() + len(match.group(1))
-                        
+                    if marker_pos >= 0:
                         if marker_pos < first_marker_pos:
                             first_marker_pos = marker_pos
-                        break  # Found a match, no need to try other patterns for this key
+                        break  # Found a match, no need to try other formats for this key
             
             # If we found any subproblem markers, cut the text before the first one
             if first_marker_pos < len(cleaned_text):
@@ -1672,6 +2311,9 @@ class SinglePDFConverter:
         # Find all potential multiple choice markers
         mc_markers = []
         
+        # Which positions fall inside a LaTeX expression, worked out in one pass
+        in_latex = self._latex_context_mask(content)
+        
         # Pattern to match multiple choice markers
         patterns = [
             r'([a-zA-Z])\)',  # a), b), c)
@@ -1685,12 +2327,7 @@ class SinglePDFConverter:
                 marker_start = match.start()
                 
                 # Skip if inside LaTeX
-                before_marker = content[:marker_start]
-                open_inline = before_marker.count('\\(') - before_marker.count('\\)')
-                open_display = before_marker.count('\\[') - before_marker.count('\\]')
-                open_dollar = before_marker.count('$') % 2
-                
-                if open_inline > 0 or open_display > 0 or open_dollar == 1:
+                if in_latex[marker_start]:
                     continue
                 
                 # Check context - should be preceded by whitespace/punctuation
@@ -1727,7 +2364,7 @@ class SinglePDFConverter:
                 # Clean up trailing whitespace and some punctuation, but preserve question marks
                 cleaned_text = cleaned_text.rstrip(' \t\n:')
                 
-                print(f"   🧹 Removed multiple choice options from problem text")
+                logger.debug("   🧹 Removed multiple choice options from problem text")
                 return cleaned_text.strip()
         
         return content
@@ -1751,10 +2388,10 @@ class SinglePDFConverter:
             
             if associated_subproblem:
                 updated_subproblems[associated_subproblem]["images"].append(image_filename)
-                print(f"   🖼️ Associated image {image_filename} with subproblem {associated_subproblem}")
+                logger.debug("   🖼️ Associated image %s with subproblem %s", image_filename, associated_subproblem)
             else:
                 main_images.append(image_filename)
-                print(f"   🖼️ Associated image {image_filename} with main problem text")
+                logger.debug("   🖼️ Associated image %s with main problem text", image_filename)
         
         return main_images, updated_subproblems
     
@@ -1762,30 +2399,26 @@ class SinglePDFConverter:
         """Determine which subproblem an image belongs to based on content and filename analysis"""
         
         # Method 1: Filename pattern analysis (e.g., "p6_b_1.png" -> subproblem b)
-        filename_match = re.search(r'p\d+_([a-z])_\d+\.png', image_filename)
+        filename_match = re.search(r'p\d+_([a-z])_\d+\.(?:png|webp)', image_filename)
         if filename_match:
             subproblem_key = filename_match.group(1)
             if subproblem_key in subproblems:
-                print(f"   🔍 Filename pattern suggests {image_filename} belongs to subproblem {subproblem_key}")
+                logger.debug("   🔍 Filename pattern suggests %s belongs to subproblem %s", image_filename, subproblem_key)
                 return subproblem_key
         
         # Method 2: Content analysis - look for visual cues in subproblem text
-        image_keywords = [
-            'shaded region', 'graph', 'figure', 'diagram', 'chart', 'below', 'above',
-            'shown', 'illustrated', 'picture', 'image', 'plot', 'curve', 'line'
-        ]
-        
         best_match = None
         max_matches = 0
         
         for subproblem_key, subproblem_data in subproblems.items():
-            subproblem_text = subproblem_data.get('problem_text', '')
+            # Lowercase once per subproblem rather than once per keyword
+            subproblem_text = subproblem_data.get('problem_text', '').lower()
             match_count = 0
             
-            for keyword in image_keywords:
-                if keyword.lower() in subproblem_text.lower():
+            for keyword in _SUBPROBLEM_IMAGE_KEYWORDS:
+                if keyword in subproblem_text:
                     match_count += 1
-                    print(f"   🔍 Found image keyword '{keyword}' in subproblem {subproblem_key}")
+                    logger.debug("   🔍 Found image keyword '%s' in subproblem %s", keyword, subproblem_key)
             
             if match_count > max_matches:
                 max_matches = match_count
@@ -1834,10 +2467,10 @@ class SinglePDFConverter:
             problem_text = problem_text.rstrip(' .:')
             
             if solution_text:
-                print(f"   📝 Found solution (length: {len(solution_text)} chars)")
+                logger.debug("   📝 Found solution (length: %s chars)", len(solution_text))
                 return problem_text, solution_text
             else:
-                print(f"   ⚠️ Solution marker found but no solution content")
+                logger.debug("   ⚠️ Solution marker found but no solution content")
                 return problem_text, None
         
         # No solution found
@@ -1870,22 +2503,22 @@ class SinglePDFConverter:
         
         return metadata
 
-    def _generate_problem_based_filename(self, associated_problem, img_num, page_num, subproblem=None):
+    def _generate_problem_based_filename(self, associated_problem, img_num, page_num, subproblem=None, ext='png'):
         """Generate filename based on problem number, with optional subproblem, fallback to page-based naming"""
         
         if associated_problem:
             if subproblem:
-                # Use problem + subproblem naming: p{problem_num}_{img_num}_{subproblem}.png
-                filename = f"p{associated_problem}_{img_num}_{subproblem}.png"
-                print(f"   📝 Generated problem+subproblem filename: {filename}")
+                # Use problem + subproblem naming: p{problem_num}_{img_num}_{subproblem}.{ext}
+                filename = f"p{associated_problem}_{img_num}_{subproblem}.{ext}"
+                logger.debug("   📝 Generated problem+subproblem filename: %s", filename)
             else:
-                # Use problem-based naming: p{problem_num}_{img_num}.png
-                filename = f"p{associated_problem}_{img_num}.png"
-                print(f"   📝 Generated problem-based filename: {filename}")
+                # Use problem-based naming: p{problem_num}_{img_num}.{ext}
+                filename = f"p{associated_problem}_{img_num}.{ext}"
+                logger.debug("   📝 Generated problem-based filename: %s", filename)
         else:
             # Fallback to page-based naming for unassociated images
-            filename = f"page_{page_num}_img_{img_num}.png"
-            print(f"   📝 Generated page-based filename (fallback): {filename}")
+            filename = f"page_{page_num}_img_{img_num}.{ext}"
+            logger.debug("   📝 Generated page-based filename (fallback): %s", filename)
         
         return filename
 
@@ -1900,7 +2533,7 @@ class SinglePDFConverter:
             # In a more sophisticated implementation, we would analyze the actual
             # problem text around the image position to detect subproblem markers
             
-            print(f"   🔍 Attempting subproblem detection for problem {problem_num}, image {img_idx}")
+            logger.debug("   🔍 Attempting subproblem detection for problem %s, image %s", problem_num, img_idx)
             
             # For demonstration, we can use some basic heuristics:
             # - If there are multiple images for the same problem, they might be for different subproblems
@@ -1918,7 +2551,7 @@ class SinglePDFConverter:
             return None
             
         except Exception as e:
-            print(f"   ⚠️ Error detecting subproblem for image: {e}")
+            logger.warning("   ⚠️ Error detecting subproblem for image: %s", e)
             return None
 
     def _separate_solution_images(self, problem_text, solution_text, images, problem_num):
@@ -1929,79 +2562,85 @@ class SinglePDFConverter:
         
         # For now, use a simple heuristic: if there's a solution and images,
         # and the problem text doesn't mention graphs/figures, images likely belong to solution
-        image_keywords = ['graph', 'figure', 'diagram', 'chart', 'below', 'above', 
-                         'shown', 'illustrated', 'picture', 'image', 'plot', 'curve', 'line',
-                         'shaded region', 'shaded area']
+        problem_text = problem_text.lower()
+        problem_mentions_image = any(keyword in problem_text for keyword in _SOLUTION_IMAGE_KEYWORDS)
         
-        problem_mentions_image = any(keyword in problem_text.lower() for keyword in image_keywords)
-        solution_mentions_image = any(keyword in solution_text.lower() for keyword in image_keywords) if solution_text else False
+        solution_mentions_image = False
+        if solution_text:
+            solution_text = solution_text.lower()
+            solution_mentions_image = any(keyword in solution_text for keyword in _SOLUTION_IMAGE_KEYWORDS)
         
         for img in images:
             # If problem mentions images, keep in main; if only solution mentions images, move to solution
             if not problem_mentions_image and solution_mentions_image:
                 solution_images.append(img)
-                print(f"   🖼️ Moving image {img} to solution for problem {problem_num}")
+                logger.debug("   🖼️ Moving image %s to solution for problem %s", img, problem_num)
             else:
                 main_images.append(img)
         
         return solution_images, main_images
 
-    def _is_header_image(self, pdf_doc, page_num, xref):
+    def _get_page_image_rects(self, page_num):
+        """Return {xref: [Rect, ...]} for every image on a page, cached per page"""
+        
+        if page_num not in self._page_img_cache:
+            page = self.pdf_doc[page_num - 1]
+            self._page_img_cache[page_num] = {
+                img[0]: page.get_image_rects(img[0]) for img in page.get_images()
+            }
+        
+        return self._page_img_cache[page_num]
+    
+    def _is_header_image(self, page_num, xref):
         """Check if an image is likely a header image based on position and size"""
         
         try:
-            page = pdf_doc[page_num - 1]  # Convert to 0-based index
+            page = self.pdf_doc[page_num - 1]  # Convert to 0-based index
             
             # Get page dimensions
             page_rect = page.rect
             page_width = page_rect.width
             page_height = page_rect.height
             
-            # Get all image instances on the page
-            img_list = page.get_images()
+            # Get this image's position on the page (rects are looked up once per page)
+            img_rects = self._get_page_image_rects(page_num).get(xref)
             
-            # Find the specific image
-            for img in img_list:
-                if img[0] == xref:
-                    # Get image position on page
-                    img_rects = page.get_image_rects(xref)
+            if img_rects:
+                for rect in img_rects:
+                    # Check if image is in the top portion of the page
+                    img_top = rect.y0
+                    img_height = rect.height
+                    img_width = rect.width
+                    img_center_x = (rect.x0 + rect.x1) / 2
                     
-                    if img_rects:
-                        for rect in img_rects:
-                            # Check if image is in the top portion of the page
-                            img_top = rect.y0
-                            img_height = rect.height
-                            img_width = rect.width
-                            img_center_x = (rect.x0 + rect.x1) / 2
-                            
-                            # Header criteria (more conservative):
-                            # 1. Located in top 10% of page (was 15%)
-                            # 2. Small height (less than 8% of page height) (was 10%)
-                            # 3. Located in the right half of the page (for PENN ID box)
-                            # 4. Must satisfy BOTH top region AND (small height OR right side)
-                            is_top_region = img_top < (page_height * 0.10)  # More conservative
-                            is_small_height = img_height < (page_height * 0.08)  # More conservative  
-                            is_right_side = img_center_x > (page_width * 0.5)
-                            
-                            # Require stricter criteria - must be small AND in top region
-                            if is_top_region and is_small_height and is_right_side:
-                                print(f"   🎯 Detected header image at top of page (y={img_top:.1f}, height={img_height:.1f})")
-                                return True
-                            
-                            # Also check if it's a very small rectangular image (like PENN ID box) - more conservative
-                            aspect_ratio = img_width / img_height if img_height > 0 else 0
-                            is_rectangular = 2.0 < aspect_ratio < 4.0  # More restrictive aspect ratio
-                            is_very_small = img_height < 40 and img_width < 120  # Smaller thresholds
-                            
-                            # Only filter if it's very clearly a header (small, rectangular, top-right)
-                            if is_top_region and is_rectangular and is_very_small and is_right_side:
-                                print(f"   🎯 Detected small rectangular header image (aspect ratio={aspect_ratio:.2f})")
-                                return True
+                    # Header criteria (more conservative):
+                    # 1. Located in top 10% of page (was 15%)
+                    # 2. Small height (less than 8% of page height) (was 10%)
+                    # 3. Located in the right half of the page (for PENN ID box)
+                    # 4. Must satisfy BOTH top region AND (small height OR right side)
+                    is_top_region = img_top < (page_height * 0.10)  # More conservative
+                    is_small_height = img_height < (page_height * 0.08)  # More conservative  
+                    is_right_side = img_center_x > (page_width * 0.5)
+                    
+                    # Require stricter criteria - must be small AND in top region
+                    if is_top_region and is_small_height and is_right_side:
+                        logger.debug("   🎯 Detected header image at top of page (y=%.1f, height=%.1f)", img_top, img_height)
+                        return True
+                    
+                    # Also check if it's a very small rectangular image (like PENN ID box) - more conservative
+                    aspect_ratio = img_width / img_height if img_height > 0 else 0
+                    is_rectangular = 2.0 < aspect_ratio < 4.0  # More restrictive aspect ratio
+                    is_very_small = img_height < 40 and img_width < 120  # Smaller thresholds
+                    
+                    # Only filter if it's very clearly a header (small, rectangular, top-right)
+                    if is_top_region and is_rectangular and is_very_small and is_right_side:
+                        logger.debug("   🎯 Detected small rectangular header image (aspect ratio=%.2f)", aspect_ratio)
+                        return True
             
             return False
             
         except Exception as e:
-            print(f"   ⚠️ Error checking if image is header: {e}")
+            logger.warning("   ⚠️ Error checking if image is header: %s", e)
             return False
 
 
@@ -2017,31 +2656,70 @@ def main():
                        help='ID prefix for the problems (e.g., math103_final_fall2014)')
     parser.add_argument('--output', '-o', type=str, default="storage/processed",
                        help='Output directory (default: storage/processed)')
+    parser.add_argument('--concurrency', '-c', type=int, default=4,
+                       help='Number of pages sent to Mathpix at once (default: 4)')
+    parser.add_argument('--pdf-timeout', type=int, default=PDF_JOB_TIMEOUT,
+                       help=f'Seconds to wait for the whole-PDF Mathpix job (default: {PDF_JOB_TIMEOUT})')
+    parser.add_argument('--dpi', type=int, default=DEFAULT_RENDER_DPI,
+                       help=f'Resolution pages are rendered at for OCR (default: {DEFAULT_RENDER_DPI})')
+    parser.add_argument('--use-text-layer', action='store_true',
+                       help="Parse PDFs with a usable embedded text layer locally and only OCR their scanned pages "
+                            "(faster and cheaper, but that text has no LaTeX and Mathpix figures are skipped)")
+    parser.add_argument('--debug', action='store_true',
+                       help='Log per-page extraction details')
+    parser.add_argument('--no-cache', action='store_true',
+                       help=f'Always call Mathpix instead of reusing earlier results, which are cached '
+                            f'in {DEFAULT_CACHE_DIR} by default')
     
     args = parser.parse_args()
     
-    # Load credentials from environment variables
-    APP_ID = os.getenv('MATHPIX_APP_ID')
-    APP_KEY = os.getenv('MATHPIX_APP_KEY')
+    # Per-page diagnostics are only formatted and emitted with --debug
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format='%(message)s')
+    
+    # Load credentials from environment variables (falling back to .env)
+    APP_ID, APP_KEY = _creds()
     
     if not APP_ID or not APP_KEY:
-        print("❌ Error: MATHPIX_APP_ID and MATHPIX_APP_KEY must be set in .env file")
+        print("❌ Error: MATHPIX_APP_ID and MATHPIX_APP_KEY must be set in the environment or .env file")
         print("Create a .env file in the root directory with:")
         print("MATHPIX_APP_ID=your_app_id_here")
         print("MATHPIX_APP_KEY=your_app_key_here")
         return
     
-    print(f"✅ Loaded Mathpix credentials from .env file")
+    # _creds() only falls back to .env for values the environment doesn't set
+    from_environment = [name for name in ('MATHPIX_APP_ID', 'MATHPIX_APP_KEY') if os.environ.get(name)]
+    if len(from_environment) == 2:
+        source = "environment"
+    elif from_environment:
+        source = "environment and .env file"
+    else:
+        source = ".env file"
+    print(f"✅ Loaded Mathpix credentials from {source}")
     
     # Initialize converter
-    converter = SinglePDFConverter(APP_ID, APP_KEY)
+    converter = SinglePDFConverter(
+        APP_ID, APP_KEY,
+        max_concurrency=args.concurrency,
+        pdf_job_timeout=args.pdf_timeout,
+        dpi=args.dpi,
+        use_text_layer=args.use_text_layer,
+        cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR
+    )
     
-    # Check if PDF file exists
-    if not os.path.exists(args.pdf):
+    # Check if PDF file exists (a single stat covers both existence and size)
+    pdf_path = Path(args.pdf)
+    try:
+        pdf_stat = pdf_path.stat()
+    except FileNotFoundError:
         print(f"❌ File not found: {args.pdf}")
         print("Make sure the PDF file exists at the specified path")
         return
     
+    if pdf_stat.st_size > MAX_PDF_BYTES:
+        print(f"❌ File too large: {args.pdf} ({pdf_stat.st_size / 1024 ** 3:.1f} GB)")
+        print("Mathpix only accepts PDFs up to 1 GB")
+        return
+    
     print(f"📁 Found PDF file: {args.pdf}")
     print(f"🏷️  Using ID prefix: {args.prefix}")
     
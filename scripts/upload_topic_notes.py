@@ -9,6 +9,7 @@ Usage:
 import os
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Dict, Optional
 from dotenv import load_dotenv
@@ -17,6 +18,9 @@ from supabase import create_client, Client
 # Load environment variables
 load_dotenv()
 
+# Uploads are network-bound, so a handful run at once
+DEFAULT_UPLOAD_WORKERS = 8
+
 def get_supabase_client() -> Client:
     """Initialize Supabase client."""
     url = os.environ.get("SUPABASE_URL")
@@ -65,6 +69,21 @@ def upload_pdf_to_storage(client: Client, file_path: Path, storage_path: str) ->
         print(f"✗ Failed to upload {file_path.name}: {e}")
         return None
 
+def parse_topic_id(filename: str) -> Optional[int]:
+    """
+    Extract the topic ID from a notes filename.
+    
+    Args:
+        filename: PDF filename (e.g., '1_limits_continuity_and_ivt.pdf')
+    
+    Returns:
+        Topic ID (e.g., 1) or None if the filename doesn't start with one
+    """
+    try:
+        return int(filename.split('_')[0])
+    except (ValueError, IndexError):
+        return None
+
 def update_database_urls(client: Client, topic_files: Dict[int, Dict]) -> None:
     """
     Update topic_notes table with file URLs and metadata.
@@ -90,6 +109,7 @@ def main():
     parser = argparse.ArgumentParser(description='Upload topic notes PDFs to Supabase')
     parser.add_argument('--notes-dir', required=True, help='Directory containing PDF files')
     parser.add_argument('--dry-run', action='store_true', help='Show what would be uploaded without uploading')
+    parser.add_argument('--workers', type=int, default=DEFAULT_UPLOAD_WORKERS, help='Number of PDFs to upload concurrently')
     args = parser.parse_args()
     
     notes_dir = Path(args.notes_dir)
@@ -102,48 +122,74 @@ def main():
     print(f"Found {len(pdf_files)} PDF files")
     
     if args.dry_run:
+        # Same topic ID check as a real run, without connecting to Supabase
         print("\nDry run - would upload:")
+        skipped = 0
         for pdf in pdf_files:
-            print(f"  {pdf.name}")
+            topic_id = parse_topic_id(pdf.name)
+            if topic_id is None:
+                print(f"  ⚠ {pdf.name} - cannot extract topic ID, would be skipped")
+                skipped += 1
+            else:
+                print(f"  {pdf.name} -> topics/{pdf.name} (topic {topic_id})")
+        print(f"\n{len(pdf_files) - skipped} to upload, {skipped} would be skipped")
         return
     
-    # Initialize Supabase client
-    try:
-        client = get_supabase_client()
-        print("Connected to Supabase")
-    except Exception as e:
-        print(f"Failed to connect to Supabase: {e}")
-        sys.exit(1)
-    
-    # Upload files and collect info
-    topic_files = {}
+    # Work out which files to upload
+    uploads = []
     
     for pdf_path in pdf_files:
         # Extract topic ID from filename (e.g., "1_limits_continuity_and_ivt.pdf" -> 1)
         filename = pdf_path.name
-        try:
-            topic_id = int(filename.split('_')[0])
-        except (ValueError, IndexError):
+        topic_id = parse_topic_id(filename)
+        if topic_id is None:
             print(f"⚠ Skipping {filename} - cannot extract topic ID")
             continue
         
         # Storage path matches what we put in the database
         storage_path = f"topics/{filename}"
         
-        # Upload file
-        url = upload_pdf_to_storage(client, pdf_path, storage_path)
+        uploads.append((topic_id, pdf_path, storage_path))
+    
+    # Nothing to do, so don't connect at all
+    if not uploads:
+        print("No files with a topic ID to upload")
+        return
+    
+    # Initialize Supabase client
+    try:
+        client = get_supabase_client()
+        print("Connected to Supabase")
+    except Exception as e:
+        print(f"Failed to connect to Supabase: {e}")
+        sys.exit(1)
+    
+    # Upload files concurrently, then collect the results in file order
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = [
+            executor.submit(upload_pdf_to_storage, client, pdf_path, storage_path)
+            for _, pdf_path, storage_path in uploads
+        ]
+    
+    topic_files = {}
+    
+    for (topic_id, pdf_path, _), future in zip(uploads, futures):
+        url = future.result()
         
         if url:
             file_size = pdf_path.stat().st_size
             topic_files[topic_id] = {
                 'url': url,
                 'size': file_size,
-                'filename': filename
+                'filename': pdf_path.name
             }
     
-    # Update database with URLs
-    print(f"\nUpdating database with {len(topic_files)} file URLs...")
-    update_database_urls(client, topic_files)
+    # Update database with URLs; skip the round-trips if every upload failed
+    if topic_files:
+        print(f"\nUpdating database with {len(topic_files)} file URLs...")
+        update_database_urls(client, topic_files)
+    else:
+        print("\nNo files were uploaded, skipping database update")
     
     # Summary
     print(f"\n=== Summary ===")